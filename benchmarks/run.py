@@ -0,0 +1,265 @@
+"""
+Benchmarks the CLI's most common commands end to end against a local fake of the Packagr API (see
+`tests/fake_api.py`), and writes the results to a JSON file so that they can be compared between commits.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Dict, Iterator, List, Optional
+from tests.fake_api import FakePackagrAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PACKAGE_NAME = 'bench'
+PACKAGE_VERSION = '0.1.0'
+
+FAKE_PIP = """#!{python}
+import sys
+sys.exit(0)
+"""
+
+
+class Environment(object):
+    """
+    A throwaway home folder (with a global config for the fake API's account), project folder and token/response
+    cache, in which the CLI is run as a separate process, exactly as a user would run it. `pip` is replaced with a
+    script that does nothing, so that installs measure the CLI rather than pip
+    """
+    def __init__(self, api: FakePackagrAPI, root: str) -> None:
+        self.api = api
+        self.home = os.path.join(root, 'home')
+        self.project = os.path.join(root, 'project')
+        self.bin = os.path.join(root, 'bin')
+
+        for path in [self.home, self.project, self.bin]:
+            os.makedirs(path)
+
+        with open(os.path.join(self.home, 'packagr_conf.toml'), 'w') as f:
+            f.write(f'hash-id = "{api.hash_id}"\nemail = "{api.email}"\npassword = "{api.password}"\n')
+
+        with open(os.path.join(self.project, 'packagr.toml'), 'w') as f:
+            f.write(f'name = "{PACKAGE_NAME}"\nversion = "{PACKAGE_VERSION}"\n')
+
+        pip = os.path.join(self.bin, 'pip')
+        with open(pip, 'w') as f:
+            f.write(FAKE_PIP.format(python=sys.executable))
+        os.chmod(pip, 0o755)
+
+        self.env = dict(
+            os.environ,
+            HOME=self.home,
+            PATH=os.pathsep.join([self.bin, os.environ.get('PATH', '')]),
+            PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]),
+            PACKAGR_API_URL=api.url,
+            PACKAGR_CACHE_DIR=os.path.join(root, 'cache'),
+        )
+
+    def run(self, args: List[str]) -> dict:
+        """
+        Runs the CLI once, returning how long it took, the requests it made and its output
+        """
+        self.api.reset()
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-c', 'from packagr import run; run()'] + args,
+            cwd=self.project,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        elapsed = time.perf_counter() - start
+
+        return {
+            'seconds': elapsed,
+            'requests': len(self.api.requests),
+            'returncode': process.returncode,
+            'output': process.stdout.decode(errors='replace'),
+        }
+
+    def write_artifact(self, size: int) -> None:
+        """
+        Writes a wheel of about `size` bytes of random (so uncompressed) data, with a RECORD that matches it
+        """
+        dist = os.path.join(self.project, 'dist')
+        shutil.rmtree(dist, ignore_errors=True)
+        os.makedirs(dist)
+
+        dist_info = f'{PACKAGE_NAME}-{PACKAGE_VERSION}.dist-info'
+        digest = hashlib.sha256()
+        path = os.path.join(dist, f'{PACKAGE_NAME}-{PACKAGE_VERSION}-py3-none-any.whl')
+        with zipfile.ZipFile(path, 'w') as archive:
+            with archive.open(f'{PACKAGE_NAME}/data.bin', 'w', force_zip64=True) as f:
+                for chunk_size in [1024 * 1024] * (size // (1024 * 1024)) + [size % (1024 * 1024)]:
+                    chunk = os.urandom(chunk_size)
+                    digest.update(chunk)
+                    f.write(chunk)
+            hash_value = base64.urlsafe_b64encode(digest.digest()).rstrip(b'=').decode()
+            archive.writestr(f'{dist_info}/RECORD',
+                             f'{PACKAGE_NAME}/data.bin,sha256={hash_value},{size}\n{dist_info}/RECORD,,\n')
+
+
+def summarize(runs: List[dict], expected: str) -> dict:
+    seconds = [run['seconds'] for run in runs]
+    failed = [run for run in runs if run['returncode'] != 0 or expected not in run['output']]
+
+    if failed:
+        sys.stderr.write(f'Unexpected output:\n{failed[0]["output"]}\n')
+
+    return {
+        'runs': len(runs),
+        'failures': len(failed),
+        'seconds': {
+            'min': min(seconds),
+            'median': statistics.median(seconds),
+            'mean': statistics.mean(seconds),
+            'max': max(seconds),
+        },
+        'requests': {
+            'min': min(run['requests'] for run in runs),
+            'max': max(run['requests'] for run in runs),
+        },
+    }
+
+
+def run_benchmarks(repeat: int = 5,
+                   latency: float = 0.0,
+                   packages: int = 100,
+                   users: int = 100,
+                   tokens: int = 1000,
+                   page_size: int = None,
+                   sizes: List[int] = None) -> dict:
+    sizes = sizes or [64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+
+    if packages * users < tokens + repeat:
+        raise ValueError('There are not enough packages and users to create new tokens for')
+
+    results: Dict[str, dict] = {}
+
+    with FakePackagrAPI(packages=packages, users=users, tokens=tokens, latency=latency, page_size=page_size) as api, \
+            tempfile.TemporaryDirectory() as root:
+        environment = Environment(api, root)
+
+        results['startup'] = summarize([environment.run(['--version']) for _ in range(repeat)], 'Console Tool')
+
+        # new tokens are created for pairs that don't have one yet, and existing tokens are deleted
+        results['create-token'] = summarize(
+            [environment.run(['create-token', *api.pair_names(tokens + i)]) for i in range(repeat)],
+            'Access token created'
+        )
+        results['delete-token'] = summarize(
+            [environment.run(['delete-token', *api.pair_names(i)]) for i in range(repeat)],
+            'Access token deleted'
+        )
+
+        results['install'] = summarize(
+            [environment.run(['install', 'some-package']) for _ in range(repeat)],
+            'some-package'
+        )
+
+        for size in sizes:
+            environment.write_artifact(size)
+            summary = summarize([environment.run(['upload']) for _ in range(repeat)], 'Uploaded 1 files successfully')
+            summary['bytes'] = size
+            summary['bytes_per_second'] = size / summary['seconds']['median']
+            results[f'upload-{size}'] = summary
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'latency': latency,
+            'packages': packages,
+            'users': users,
+            'tokens': tokens,
+            'page_size': page_size,
+        },
+        'results': results,
+    }
+
+
+def git_commit() -> Optional[str]:
+    with contextlib.suppress(OSError, subprocess.CalledProcessError):
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    return None
+
+
+def report(results: dict, baseline: dict = None) -> Iterator[str]:
+    """
+    Yields a line for each benchmark, with the change in median time from the baseline if one is given
+    """
+    for name, result in results['results'].items():
+        median = result['seconds']['median']
+        line = f'{name:<20} {median * 1000:>9.1f} ms  {result["requests"]["max"]:>3} requests'
+
+        if 'bytes_per_second' in result:
+            line += f'  {result["bytes_per_second"] / 1024 / 1024:>8.1f} MB/s'
+
+        previous = (baseline or {}).get('results', {}).get(name)
+        if previous:
+            line += f'  {(median / previous["seconds"]["median"] - 1) * 100:>+7.1f}%'
+
+        if result['failures']:
+            line += f'  ({result["failures"]} failed)'
+
+        yield line
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark.json', help='The file to write the results to')
+    parser.add_argument('--compare', help='The results of a previous run to compare against')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of times to run each command')
+    parser.add_argument('--latency', type=float, default=0.05, help='The delay of each API request, in seconds')
+    parser.add_argument('--packages', type=int, default=100, help='The number of packages in the account')
+    parser.add_argument('--users', type=int, default=100, help='The number of users in the account')
+    parser.add_argument('--tokens', type=int, default=1000, help='The number of access tokens in the account')
+    parser.add_argument('--page-size', type=int, help='Paginate listings with this many items per page')
+    parser.add_argument('--sizes', type=int, nargs='+', help='The sizes of the files to upload, in bytes')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        repeat=args.repeat,
+        latency=args.latency,
+        packages=args.packages,
+        users=args.users,
+        tokens=args.tokens,
+        page_size=args.page_size,
+        sizes=args.sizes,
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.loads(f.read())
+
+    for line in report(results, baseline):
+        print(line)
+
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=2))
+
+    return 1 if any(result['failures'] for result in results['results'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
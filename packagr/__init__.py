@@ -1,7 +1,16 @@
 __version__ = '0.1.0'
 
-from packagr.packagr import application
-
 
 def run():
-    application.run()
\ No newline at end of file
+    """
+    Hands the command over to `packagr agent` if it is running, or runs it in this process. The application is only
+    imported in the second case, as the agent has already imported it
+    """
+    import sys
+    from packagr.agent import forward
+
+    status = forward(sys.argv[1:])
+    if status is None:
+        from packagr.packagr import application
+        status = application.run()
+    sys.exit(status)
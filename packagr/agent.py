@@ -0,0 +1,372 @@
+"""
+`packagr agent` keeps a process running in the background that has already imported the CLI's dependencies and holds
+on to its HTTP session, parsed config files and (if `PACKAGR_CACHE_TTL` allows it) the listings of the account's
+packages, users and tokens. The `packagr` command hands each invocation over to it through a Unix domain socket,
+along with its standard input, output and error, and only runs the command itself if the agent isn't running.
+
+This module is imported by every `packagr` invocation, so the client side only uses the standard library
+"""
+import array
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from packagr import __version__
+
+SOCKET_PATH = os.environ.get('PACKAGR_AGENT_SOCKET', os.path.expanduser('~/.packagr/agent.sock'))
+IDLE_TIMEOUT = float(os.environ.get('PACKAGR_AGENT_IDLE_TIMEOUT', 15 * 60))
+
+# commands that are always run by the `packagr` process itself
+LOCAL_COMMANDS = {'agent'}
+# environment variables that are read once, when the CLI is imported (e.g. the cache and mirror folders), so the agent
+# only runs commands for clients that agree on them. The rest of the client's environment is applied to each command
+STARTUP_ENVIRONMENT = ['HOME']
+STDIO = (0, 1, 2)
+
+
+def environment() -> Dict[str, str]:
+    return dict(os.environ)
+
+
+def startup_environment(env: Dict[str, str]) -> Dict[str, Optional[str]]:
+    names = STARTUP_ENVIRONMENT + sorted(name for name in env if name.startswith('PACKAGR_'))
+    return {name: env.get(name) for name in names}
+
+
+def global_config_stamp() -> Optional[List[int]]:
+    try:
+        stat = os.stat(os.path.expanduser('~/packagr_conf.toml'))
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def send(sock: socket.socket, message: Dict[str, Any], fds: Sequence[int] = ()) -> None:
+    data = json.dumps(message).encode() + b'\n'
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    sent = sock.sendmsg([data], ancillary)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def receive(sock: socket.socket) -> Tuple[Dict[str, Any], List[int]]:
+    """
+    Reads a message, along with any file descriptors sent with it
+    """
+    fds = array.array('i')
+    data, ancillary, _, _ = sock.recvmsg(65536, socket.CMSG_SPACE(len(STDIO) * fds.itemsize))
+
+    for level, kind, content in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(content[:len(content) - len(content) % fds.itemsize])
+
+    while data and not data.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+
+    return json.loads(data.decode()) if data else {}, list(fds)
+
+
+def connect(path: str = None) -> Optional[socket.socket]:
+    """
+    Connects to the agent, returning None if it isn't running
+    """
+    path = path or SOCKET_PATH
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    # commands take as long as they take
+    sock.settimeout(None)
+    return sock
+
+
+def request(message: Dict[str, Any], path: str = None) -> Optional[Dict[str, Any]]:
+    """
+    Sends a message to the agent and waits for its reply. Returns None if the agent isn't running
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+
+    with sock:
+        try:
+            send(sock, message)
+            reply, _ = receive(sock)
+        except (OSError, ValueError):
+            return None
+
+    return reply or None
+
+
+def forward(argv: List[str], path: str = None, fds: Sequence[int] = STDIO) -> Optional[int]:
+    """
+    Runs a command in the agent, with this process's standard input, output and error. Returns its exit code, or None
+    if it has to be run in this process instead
+    """
+    if argv and argv[0] in LOCAL_COMMANDS:
+        return None
+
+    sock = connect(path)
+    if sock is None:
+        return None
+
+    message = {
+        'command': 'run',
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': environment(),
+        'executable': sys.executable,
+        'version': __version__,
+    }
+
+    with sock:
+        try:
+            send(sock, message, fds)
+        except OSError:
+            return None
+
+        try:
+            reply, _ = receive(sock)
+        except (OSError, ValueError):
+            reply = {}
+
+    if 'fallback' in reply:
+        return None
+    if 'exit' not in reply:
+        # the command may have been run, so it isn't run again
+        os.write(2, b'Lost the connection to packagr agent before the command finished\n')
+        return 1
+    return reply['exit']
+
+
+class Agent(object):
+    """
+    Runs the commands sent to it by `packagr` processes until it hasn't been sent one for `idle_timeout` seconds. A
+    command changes the process's standard streams, working directory and environment, so only one runs at a time,
+    in a worker thread; clients that connect while it is busy are told to run their command themselves rather than
+    wait for it. The shared state that depends on the global config (the HTTP client and the inventory) is dropped
+    whenever the config changes
+    """
+    def __init__(self, path: str = None, idle_timeout: float = IDLE_TIMEOUT) -> None:
+        self.path = path or SOCKET_PATH
+        self.idle_timeout = idle_timeout
+        self.started = time.time()
+        self.served = 0
+        self.running = False
+        self.stamp = global_config_stamp()
+        self.cwd = os.getcwd()
+        self.environment = environment()
+        self.application: Any = None
+        self.lock = threading.Lock()
+        self.worker: Optional[threading.Thread] = None
+
+    def warm_up(self) -> None:
+        """
+        Imports every command, and everything they use, before the first one is run
+        """
+        import importlib
+        from packagr.packagr import application, commands
+
+        for module in commands:
+            importlib.import_module(module)
+
+        self.application = application
+
+    def listen(self) -> socket.socket:
+        if request({'command': 'status'}, path=self.path):
+            raise RuntimeError(f'An agent is already running at {self.path}')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        sock.settimeout(self.idle_timeout or None)
+        return sock
+
+    def serve(self) -> None:
+        self.warm_up()
+        sock = self.listen()
+        self.running = True
+
+        try:
+            while self.running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    if self.busy():
+                        continue
+                    break
+
+                conn.settimeout(None)
+                try:
+                    handed_over = self.handle(conn)
+                except Exception:
+                    traceback.print_exc()
+                    handed_over = False
+                if not handed_over:
+                    conn.close()
+        finally:
+            self.running = False
+            sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            # the command that is running is left to finish
+            if self.worker:
+                self.worker.join()
+
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+    def handle(self, conn: socket.socket) -> bool:
+        """
+        Replies to a message, or starts running the command it asks for. Returns True if the connection has been handed
+        over to the worker thread running the command
+        """
+        message, fds = receive(conn)
+        reply: Dict[str, Any]
+
+        try:
+            command = message.get('command')
+            if command == 'run':
+                reason = self.refuse(message, fds)
+                if not reason and self.lock.acquire(blocking=False):
+                    self.worker = threading.Thread(target=self.work, args=(conn, message, fds), daemon=True)
+                    self.worker.start()
+                    # the worker closes them once the command has finished
+                    fds = []
+                    return True
+                reply = {'fallback': reason or 'The agent is busy'}
+            elif command == 'status':
+                reply = self.status()
+            elif command == 'stop':
+                self.running = False
+                reply = {'stopped': True}
+            else:
+                reply = {'error': f'Unknown command {command}'}
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        send(conn, reply)
+        return False
+
+    def work(self, conn: socket.socket, message: Dict[str, Any], fds: List[int]) -> None:
+        """
+        Runs a command in the worker thread, and replies with its exit code
+        """
+        with conn:
+            try:
+                reply = self.run(message, fds)
+            except Exception:
+                traceback.print_exc()
+                return
+            finally:
+                for fd in fds:
+                    os.close(fd)
+                # the next command can start as soon as this one has finished
+                self.lock.release()
+
+            send(conn, reply)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'pid': os.getpid(),
+            'version': __version__,
+            'socket': self.path,
+            'started': self.started,
+            'served': self.served,
+            'idle_timeout': self.idle_timeout,
+        }
+
+    def refuse(self, message: Dict[str, Any], fds: List[int]) -> Optional[str]:
+        """
+        Returns why a command cannot be run by this agent, if it can't
+        """
+        if message.get('version') != __version__ or message.get('executable') != sys.executable:
+            # a different version of Packagr CLI has been installed since the agent was started
+            self.running = False
+            return 'The agent is out of date'
+        env = message.get('env')
+        if not isinstance(env, dict) or startup_environment(env) != startup_environment(self.environment):
+            return 'The environment is different'
+        if len(fds) != len(STDIO):
+            return 'Standard input and output were not sent'
+        return None
+
+    def invalidate(self) -> None:
+        """
+        Drops the state that depends on the global config, if it has changed since the last command
+        """
+        from packagr.client import set_client
+        from packagr.registry import inventory
+
+        stamp = global_config_stamp()
+        if stamp != self.stamp:
+            self.stamp = stamp
+            set_client(None)
+            inventory.invalidate()
+
+    def run(self, message: Dict[str, Any], fds: List[int]) -> Dict[str, Any]:
+        self.invalidate()
+
+        saved = [os.dup(fd) for fd in STDIO]
+        streams = sys.stdin, sys.stdout, sys.stderr
+        try:
+            # the command sees the client's environment, e.g. for pip, proxies and VIRTUAL_ENV
+            os.environ.clear()
+            os.environ.update(message['env'])
+            for fd, target in zip(fds, STDIO):
+                os.dup2(fd, target)
+            # fresh streams, so that nothing buffered for one client is seen by the next
+            sys.stdin = open(0, 'r', closefd=False)
+            sys.stdout = open(1, 'w', buffering=1, closefd=False)
+            sys.stderr = open(2, 'w', buffering=1, closefd=False)
+            os.chdir(message['cwd'])
+
+            status = self.execute(message['argv'])
+        finally:
+            for stream in (sys.stdin, sys.stdout, sys.stderr):
+                stream.close()
+            sys.stdin, sys.stdout, sys.stderr = streams
+            for fd, target in zip(saved, STDIO):
+                os.dup2(fd, target)
+                os.close(fd)
+            os.chdir(self.cwd)
+            os.environ.clear()
+            os.environ.update(self.environment)
+            self.served += 1
+
+        return {'exit': status}
+
+    def execute(self, argv: List[str]) -> int:
+        from clikit.args import ArgvArgs
+
+        try:
+            return self.application.run(ArgvArgs(['packagr'] + argv))
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            return e.code if isinstance(e.code, int) else 1
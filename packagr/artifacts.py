@@ -0,0 +1,215 @@
+"""
+Checks built packages before they are uploaded, so that a file left broken by an interrupted build is caught on this
+machine rather than by everyone who installs it. Each file is memory-mapped and read once for its digests, and once
+more to check its structure: every entry of a zip (and the RECORD hashes of a wheel) or the whole tar stream of an
+sdist. Files are checked in a thread pool; hashing and decompression release the GIL, so large files use every core
+"""
+import base64
+import csv
+import hashlib
+import io
+import mmap
+import os
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Type
+
+try:
+    import lzma
+except ImportError:  # Python built without it
+    lzma = None  # type: ignore
+
+CHUNK_SIZE = 1024 * 1024
+
+# the errors raised when reading a damaged archive
+CORRUPT_ERRORS: Tuple[Type[Exception], ...] = (tarfile.TarError, zipfile.BadZipFile, zlib.error, csv.Error, EOFError,
+                                               OSError, ValueError, KeyError, NotImplementedError)
+if lzma is not None:
+    CORRUPT_ERRORS += (lzma.LZMAError,)
+
+# files of a wheel that RECORD does not list
+UNRECORDED = ('RECORD', 'RECORD.jws', 'RECORD.p7s')
+
+
+class MappedFile(io.RawIOBase):
+    """
+    A read-only file over a memory map, for the archive readers (mmap objects aren't quite file objects before
+    Python 3.13)
+    """
+    def __init__(self, content: mmap.mmap) -> None:
+        super().__init__()
+        self.content = content
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.content.seek(offset, whence)  # type: ignore
+        return self.content.tell()
+
+    def tell(self) -> int:
+        return self.content.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self.content.read(size if size is not None and size >= 0 else None)
+
+    def readinto(self, buffer) -> int:
+        data = self.content.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class Artifact(object):
+    """
+    A built package file: its size and digests, and what is wrong with it, if anything
+    """
+    def __init__(self,
+                 path: str,
+                 size: int = 0,
+                 sha256: Optional[str] = None,
+                 md5: Optional[str] = None,
+                 error: Optional[str] = None) -> None:
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.md5 = md5
+        self.error = error
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return f'<Artifact {self.name} {"ok" if self.ok else self.error}>'
+
+
+def read_entry(archive: zipfile.ZipFile, info: zipfile.ZipInfo, algorithm: Optional[str] = None) -> Tuple[int, str]:
+    """
+    Reads a zip entry to the end, which checks its CRC. Returns its size and its digest in the format of a wheel's
+    RECORD (e.g. `sha256=...`) if an algorithm is given
+    """
+    digest = hashlib.new(algorithm) if algorithm else None
+    size = 0
+
+    with archive.open(info) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            size += len(chunk)
+            if digest:
+                digest.update(chunk)
+
+    if not digest:
+        return size, ''
+    return size, f'{algorithm}=' + base64.urlsafe_b64encode(digest.digest()).rstrip(b'=').decode()
+
+
+def check_wheel(archive: zipfile.ZipFile) -> Optional[str]:
+    """
+    Returns what is wrong with a wheel: an entry that doesn't match its RECORD hash or size, or a file that RECORD
+    doesn't list (or the other way round)
+    """
+    records = [name for name in archive.namelist() if name.count('/') == 1 and name.endswith('.dist-info/RECORD')]
+    if len(records) != 1:
+        return 'The wheel has no .dist-info/RECORD file' if not records else 'The wheel has several RECORD files'
+
+    dist_info = records[0].split('/')[0]
+    text = archive.read(records[0]).decode('utf-8')
+    recorded: Dict[str, Tuple[str, str]] = {}
+    for row in csv.reader(io.StringIO(text)):
+        if row:
+            path, digest, size = (row + ['', ''])[:3]
+            recorded[path] = (digest, size)
+
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+
+        if info.filename not in recorded:
+            if info.filename in [f'{dist_info}/{name}' for name in UNRECORDED]:
+                read_entry(archive, info)
+                continue
+            return f'{info.filename} is not listed in RECORD'
+
+        digest, size = recorded.pop(info.filename)
+        algorithm = digest.split('=', 1)[0] if digest else None
+        if algorithm and algorithm not in hashlib.algorithms_available:
+            return f'{info.filename} has a hash of an unknown kind in RECORD: {algorithm}'
+
+        actual_size, actual_digest = read_entry(archive, info, algorithm)
+        if (digest and actual_digest != digest) or (size and str(actual_size) != size):
+            return f'{info.filename} does not match its hash in RECORD'
+
+    if recorded:
+        return f'{sorted(recorded)[0]} is listed in RECORD but missing from the wheel'
+    return None
+
+
+def check_structure(path: str, content: mmap.mmap) -> Optional[str]:
+    """
+    Returns what is wrong with the archive in `content`, judging by the name of the file. Files that aren't
+    archives aren't checked
+    """
+    name = path.lower()
+
+    if name.endswith('.whl') or name.endswith('.zip'):
+        with zipfile.ZipFile(MappedFile(content)) as archive:
+            if name.endswith('.whl'):
+                return check_wheel(archive)
+            bad = archive.testzip()
+            return f'{bad} is damaged' if bad else None
+
+    if '.tar' in name or name.endswith('.tgz'):
+        with tarfile.open(fileobj=MappedFile(content), mode='r:*') as archive:
+            for member in archive:
+                f = archive.extractfile(member) if member.isfile() else None
+                if f is not None:
+                    while f.read(CHUNK_SIZE):
+                        pass
+        return None
+
+    return None
+
+
+def verify(path: str) -> Artifact:
+    """
+    Computes the sha256 and md5 digests of a file and checks that it is a complete, undamaged archive
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return Artifact(path, error='The file is empty')
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                sha256, md5 = hashlib.sha256(), hashlib.md5()
+                with memoryview(content) as view:
+                    for offset in range(0, size, CHUNK_SIZE):
+                        with view[offset:offset + CHUNK_SIZE] as chunk:
+                            sha256.update(chunk)
+                            md5.update(chunk)
+
+                artifact = Artifact(path, size, sha256.hexdigest(), md5.hexdigest())
+                try:
+                    artifact.error = check_structure(path, content)
+                except CORRUPT_ERRORS as e:
+                    artifact.error = str(e) or e.__class__.__name__
+    except OSError as e:
+        return Artifact(path, error=e.strerror or str(e))
+
+    return artifact
+
+
+def verify_all(paths: List[str], jobs: int = None) -> List[Artifact]:
+    """
+    Verifies several files at once, returning them in the same order
+    """
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        return list(executor.map(verify, paths))
@@ -0,0 +1,240 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Optional
+
+CACHE_DIR = os.environ.get('PACKAGR_CACHE_DIR', os.path.expanduser('~/.packagr/cache'))
+CACHE_TTL = float(os.environ.get('PACKAGR_CACHE_TTL', 0))
+CACHE_SIZE = int(os.environ.get('PACKAGR_CACHE_SIZE', 50 * 1024 * 1024))
+WHEELHOUSE_SIZE = int(os.environ.get('PACKAGR_WHEELHOUSE_SIZE', 1024 * 1024 * 1024))
+# how long to remember what the API supports before checking again, in case the server has been upgraded
+CAPABILITY_TTL = 24 * 60 * 60
+
+
+def atomic_write(path: str, content: bytes, mode: int = None) -> None:
+    """
+    Writes content to a temporary file next to `path` and renames it into place, so that concurrent readers only
+    ever see a complete file. The file is only readable by its owner unless a `mode` is given
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def jwt_claims(token: str) -> Optional[dict]:
+    """
+    Returns the (unverified) claims of a JWT, or None if the token cannot be decoded
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims: Any = json.loads(base64.urlsafe_b64decode(payload.encode()))
+        assert isinstance(claims, dict)
+        return claims
+    except (IndexError, ValueError, TypeError, AssertionError):
+        return None
+
+
+def jwt_expiry(token: str) -> Optional[int]:
+    """
+    Returns the `exp` claim of a JWT, or None if the token cannot be decoded or has no expiry
+    """
+    try:
+        return int((jwt_claims(token) or {})['exp'])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def identity(headers: Optional[dict]) -> str:
+    """
+    Returns a key identifying who a request is made on behalf of. For login tokens, this only depends on the claims
+    that stay the same when the token is refreshed
+    """
+    authorization = (headers or {}).get('Authorization', '')
+    claims = jwt_claims(authorization.split(' ')[-1]) if authorization.startswith('JWT ') else None
+
+    if claims is not None:
+        authorization = json.dumps(
+            {key: value for key, value in claims.items() if key not in ('exp', 'iat', 'orig_iat', 'jti')},
+            sort_keys=True
+        )
+
+    return hashlib.sha256(authorization.encode()).hexdigest()
+
+
+class TokenCache(object):
+    """
+    Stores login tokens on disk, one file per account/endpoint pair, until shortly before they expire
+    """
+    leeway = 30
+
+    def __init__(self, root: str = None) -> None:
+        self.root = root or os.path.join(CACHE_DIR, 'tokens')
+
+    def path(self, account: str, endpoint: str) -> str:
+        key = hashlib.sha256(f'{account}|{endpoint}'.encode()).hexdigest()
+        return os.path.join(self.root, f'{key}.json')
+
+    def get(self, account: str, endpoint: str) -> Optional[str]:
+        try:
+            with open(self.path(account, endpoint), 'r') as f:
+                entry = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('expires', 0) - self.leeway <= time.time():
+            return None
+
+        return entry.get('token')
+
+    def set(self, account: str, endpoint: str, token: str) -> bool:
+        """
+        Caches a token, returning False if its expiry cannot be determined (in which case it is not cached)
+        """
+        expires = jwt_expiry(token)
+        if not expires:
+            return False
+
+        try:
+            atomic_write(self.path(account, endpoint), json.dumps({'token': token, 'expires': expires}).encode())
+        except OSError:
+            return False
+
+        return True
+
+    def invalidate(self, account: str, endpoint: str) -> None:
+        try:
+            os.remove(self.path(account, endpoint))
+        except OSError:
+            pass
+
+
+class CapabilityCache(object):
+    """
+    Remembers which optional features (such as filtering a listing) the API supports, per account and endpoint
+    """
+    def __init__(self, root: str = None, ttl: float = CAPABILITY_TTL) -> None:
+        self.root = root or os.path.join(CACHE_DIR, 'capabilities')
+        self.ttl = ttl
+
+    def path(self, owner: str, endpoint: str) -> str:
+        key = hashlib.sha256(f'{owner}|{endpoint}'.encode()).hexdigest()
+        return os.path.join(self.root, f'{key}.json')
+
+    def get(self, owner: str, endpoint: str) -> Optional[bool]:
+        """
+        Returns whether the endpoint supports the feature, or None if that isn't known (or was found out too long ago)
+        """
+        try:
+            with open(self.path(owner, endpoint), 'r') as f:
+                entry = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get('checked', 0) >= self.ttl:
+            return None
+
+        return entry.get('supported')
+
+    def set(self, owner: str, endpoint: str, supported: bool) -> None:
+        try:
+            entry = {'supported': supported, 'checked': time.time()}
+            atomic_write(self.path(owner, endpoint), json.dumps(entry).encode())
+        except OSError:
+            pass
+
+
+class ResponseCache(object):
+    """
+    Stores the bodies of GET responses on disk along with their validators (ETag / Last-Modified), so that repeat
+    requests can be made conditionally. Entries younger than `ttl` seconds are reused without asking the server at all.
+    The least recently used entries are evicted once the cache grows beyond `max_size` bytes
+    """
+    def __init__(self, root: str = None, ttl: float = None, max_size: int = None) -> None:
+        self.root = root or os.path.join(CACHE_DIR, 'responses')
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.max_size = CACHE_SIZE if max_size is None else max_size
+
+    def path(self, url: str, owner: str) -> str:
+        key = hashlib.sha256(f'{owner}|{url}'.encode()).hexdigest()
+        return os.path.join(self.root, f'{key}.json')
+
+    def get(self, url: str, owner: str) -> Optional[dict]:
+        path = self.path(url, owner)
+
+        try:
+            with open(path, 'r') as f:
+                entry = json.loads(f.read())
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry.get('stored', 0) < self.ttl
+
+    def set(self, url: str, owner: str, content: bytes, etag: str = None, last_modified: str = None) -> None:
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored': time.time(),
+            'content': content.decode('utf-8'),
+        }
+
+        try:
+            atomic_write(self.path(url, owner), json.dumps(entry).encode())
+            self.evict()
+        except (OSError, UnicodeDecodeError):
+            pass
+
+    def revalidated(self, url: str, owner: str, entry: dict) -> None:
+        """
+        Marks an entry as fresh again after the server confirmed it has not changed
+        """
+        entry['stored'] = time.time()
+        try:
+            atomic_write(self.path(url, owner), json.dumps(entry).encode())
+        except OSError:
+            pass
+
+    def invalidate(self, url: str, owner: str) -> None:
+        try:
+            os.remove(self.path(url, owner))
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits within `max_size`
+        """
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
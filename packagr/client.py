@@ -0,0 +1,243 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Mapping, Optional, Tuple, Union
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from packagr.timings import timings
+
+if TYPE_CHECKING:
+    import requests
+
+API_URL = os.environ.get('PACKAGR_API_URL', 'https://api.packagr.app/')
+RETRIES = int(os.environ.get('PACKAGR_RETRIES', 4))
+RATE_LIMIT = float(os.environ.get('PACKAGR_RATE_LIMIT', 0))
+
+# requests that can be sent again without side effects
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# 429 and 503 mean the server is overloaded, so every request backs off, not just the one that was rejected
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+def content_length(headers: Mapping[str, Union[str, bytes]]) -> Optional[int]:
+    """
+    Returns the size of a request or response body from its headers, if they give it
+    """
+    value = headers.get('Content-Length') or ''
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    return int(value) if value.isdigit() else None
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed request is tried again, and how long to wait first: the time given by the server's
+    `Retry-After` header if there is one, otherwise an exponential backoff with (full) jitter, so that parallel
+    requests that failed together don't all retry at the same moment
+    """
+    def __init__(self, retries: int = RETRIES, backoff: float = 0.5, max_backoff: float = 30,
+                 max_retry_after: float = 300) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+
+    def should_retry(self, attempt: int, retryable: bool, response: Optional['requests.Response']) -> bool:
+        """
+        Requests that were rejected with a 429 were never processed, so they are always safe to send again. Other
+        failures (including connection errors, where `response` is None) are only retried if the request is
+        retryable
+        """
+        if attempt >= self.retries:
+            return False
+        if response is None:
+            return retryable
+        if response.status_code == 429:
+            retry_after = self.retry_after(response)
+            return retry_after is None or retry_after <= self.max_retry_after
+        return retryable and response.status_code in RETRY_STATUSES
+
+    @staticmethod
+    def retry_after(response: Optional['requests.Response']) -> Optional[float]:
+        value = response.headers.get('Retry-After') if response is not None else None
+
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int, response: Optional['requests.Response']) -> float:
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of requests made by all threads of the process (a token bucket of `rate` requests per second,
+    allowing bursts of `burst`, or no limit if `rate` is 0). It can also be paused, e.g. when the server asks clients
+    to back off, which makes every thread wait
+    """
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.allowance = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Waits until a request can be made, returning how long that took
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+
+            if self.rate:
+                self.allowance = min(self.burst, self.allowance + (now - self.updated) * self.rate)
+                self.updated = now
+                # the request is counted straight away, so that threads waiting at the same time queue up behind it
+                self.allowance -= 1
+                if self.allowance < 0:
+                    wait = max(wait, -self.allowance / self.rate)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Client(object):
+    """
+    Owns the pooled HTTP session used for all requests to the Packagr API, so that connections are kept alive and
+    reused between calls
+    """
+    def __init__(self,
+                 base_url: str = None,
+                 timeout: Tuple[float, float] = (5, 60),
+                 pool_size: int = 10,
+                 retry: RetryPolicy = None,
+                 limiter: RateLimiter = None) -> None:
+        self.base_url = base_url or API_URL
+        if not self.base_url.endswith('/'):
+            self.base_url += '/'
+        self.timeout = timeout
+        self.retry = retry or RetryPolicy()
+        self.limiter = limiter or RateLimiter()
+
+        # requests is imported here rather than at the top, as it is slow to import and many commands don't need it
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.errors = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def url(self, path: str) -> str:
+        return urljoin(self.base_url, path.lstrip('/'))
+
+    def index_url(self, hash_id: str, email: str, password: str) -> str:
+        """
+        Returns the authenticated package index url for an account, as used by pip
+        """
+        scheme, netloc, path, query, fragment = urlsplit(self.url(f'{hash_id}/'))
+        return urlunsplit((scheme, f'{email}:{password}@{netloc}', path, query, fragment))
+
+    def request(self, method: str, path: str, retry: bool = None, **kwargs) -> 'requests.Response':
+        """
+        Sends a request to a path relative to the base url (absolute urls are used as they are). Failed requests are
+        retried according to the client's retry policy if `retry` is set, which it is by default for idempotent
+        methods. A request with a streamed body is only retried if the body can be rewound
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        method = method.upper()
+        url = self.url(path)
+        data = kwargs.get('data')
+        rewind = getattr(data, 'rewind', None)
+
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        if hasattr(data, 'read') and rewind is None:
+            retry = False
+
+        attempt = 0
+        while True:
+            if attempt and rewind is not None:
+                rewind()
+
+            waited = self.limiter.acquire()
+            if waited:
+                timings.add('wait', f'{method} {url}', waited)
+
+            response, error = None, None
+            with timings.phase('http', f'{method} {url}') as details:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except self.errors as e:
+                    error = e
+                    details['error'] = e.__class__.__name__
+
+                if timings.enabled and response is not None:
+                    details['status'] = response.status_code
+                    details['sent'] = content_length(response.request.headers) or 0
+                    # the body of a streamed response (e.g. a wheel download) is left unread, rather than buffered
+                    # just to be counted
+                    if kwargs.get('stream'):
+                        details['received'] = content_length(response.headers)
+                    else:
+                        details['received'] = len(response.content)
+
+            if not self.retry.should_retry(attempt, retry, response):
+                if error:
+                    raise error
+                # without an error, the request got a response
+                assert response is not None
+                return response
+
+            delay = self.retry.delay(attempt, response)
+            if response is not None and response.status_code in THROTTLE_STATUSES:
+                self.limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client: Optional[Client] = None
+
+
+def get_client() -> Client:
+    """
+    Returns the client shared by the whole process
+    """
+    global _client
+    if _client is None:
+        _client = Client()
+    return _client
+
+
+def set_client(client: Optional[Client]) -> None:
+    """
+    Replaces the shared client, e.g. to point the CLI at a different host
+    """
+    global _client
+    if _client is not None and _client is not client:
+        _client.close()
+    _client = client
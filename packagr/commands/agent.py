@@ -0,0 +1,105 @@
+from packagr import agent
+from packagr.commands.base import Command
+from typing import Optional
+import os
+import subprocess
+import sys
+import time
+
+
+class AgentCommand(Command):
+    """
+    Starts, stops or checks on a background process that runs Packagr CLI commands without starting up from scratch
+
+    agent
+        {action : One of start, stop, status or run (to run the agent in the foreground)}
+        {--idle-timeout= : Stop the agent after this many seconds without a command. Defaults to 15 minutes}
+    """
+    actions = ['start', 'stop', 'status', 'run']
+    start_timeout = 10
+
+    def handle(self) -> Optional[int]:
+        action = self.argument('action')
+
+        if action not in self.actions:
+            self.line(f'<error>Unknown action {action}. Use one of {", ".join(self.actions)}</error>')
+            return 1
+
+        idle_timeout = self.get_idle_timeout()
+        if idle_timeout is None:
+            return 1
+
+        if action == 'run':
+            return self.run_agent(idle_timeout)
+        elif action == 'start':
+            return self.start(idle_timeout)
+        elif action == 'stop':
+            return self.stop()
+        return self.status()
+
+    def get_idle_timeout(self) -> Optional[float]:
+        try:
+            idle_timeout = float(self.option('idle-timeout') or agent.IDLE_TIMEOUT)
+            assert idle_timeout >= 0
+        except (ValueError, AssertionError):
+            self.line('<error>--idle-timeout must be a number of seconds</error>')
+            return None
+
+        return idle_timeout
+
+    def run_agent(self, idle_timeout: float) -> int:
+        try:
+            agent.Agent(idle_timeout=idle_timeout).serve()
+        except (RuntimeError, OSError) as e:
+            self.line(f'<error>{e}</error>')
+            return 1
+        return 0
+
+    def start(self, idle_timeout: float) -> int:
+        if agent.request({'command': 'status'}):
+            self.line('<comment>The agent is already running</comment>')
+            return 0
+
+        log_path = os.path.join(os.path.dirname(agent.SOCKET_PATH), 'agent.log')
+        os.makedirs(os.path.dirname(log_path), mode=0o700, exist_ok=True)
+
+        with open(os.devnull, 'r') as devnull, open(log_path, 'a') as log:
+            subprocess.Popen(
+                [sys.executable, '-c', 'from packagr import run; run()', 'agent', 'run',
+                 '--idle-timeout', str(idle_timeout)],
+                stdin=devnull,
+                stdout=log,
+                stderr=log,
+                cwd=os.path.expanduser('~'),
+                start_new_session=True,
+            )
+
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            status = agent.request({'command': 'status'})
+            if status:
+                self.line(f'<info>Agent started (pid {status["pid"]}), listening on {status["socket"]}</info>')
+                return 0
+            time.sleep(0.05)
+
+        self.line(f'<error>The agent did not start. See {log_path} for details</error>')
+        return 1
+
+    def stop(self) -> int:
+        if not agent.request({'command': 'stop'}):
+            self.line('<comment>The agent is not running</comment>')
+            return 0
+
+        self.line('<info>Agent stopped</info>')
+        return 0
+
+    def status(self) -> int:
+        status = agent.request({'command': 'status'})
+        if not status:
+            self.line('The agent is not running')
+            return 1
+
+        self.line(f'Agent {status["version"]} running (pid {status["pid"]}) on {status["socket"]}')
+        self.line(f'Up for {time.time() - status["started"]:.0f}s, ran {status["served"]} commands, '
+                  f'stops after {status["idle_timeout"]:.0f}s without one')
+        return 0
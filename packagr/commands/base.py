@@ -1,17 +1,101 @@
 from cleo import Command as BaseCommand
 from packagr import utilities
-from typing import Any, Optional, MutableMapping, Union, List
+from typing import Any, Callable, Dict, Iterator, Optional, MutableMapping, Union, List
+from packagr.cache import identity
 from packagr.objects import Package, Token, User
+from packagr.registry import Registry, inventory
+from packagr.timings import timings
+import copy
 import os
+import subprocess
+
+
+class Session(object):
+    """
+    What a command builds up while it runs and may reuse: the login headers, the account's inventory and the config
+    files it has read and changed. Every run of a command gets a new one, except under `packagr batch`, which shares
+    one between all of its commands so that config changes are only written once, at the end
+    """
+    def __init__(self) -> None:
+        self.headers: Optional[dict] = None
+        self.registry: Optional[Registry] = None
+        self.config_bases: Dict[str, MutableMapping[str, Any]] = {}
+        self.config_changes: Dict[str, MutableMapping[str, Any]] = {}
+
+    def flush(self) -> None:
+        """
+        Writes the config files that have been changed. Changes made to the same files by other processes in the
+        meantime are merged rather than overwritten
+        """
+        changes, self.config_changes = self.config_changes, {}
+
+        for path, config in changes.items():
+            utilities.write_package_content(config, path=path, base=self.config_bases.get(path))
+            self.config_bases[path] = copy.deepcopy(config)
 
 
 class Command(BaseCommand):
+    session: Session = Session()
+    # set by `packagr batch` to run the command as part of a larger session
+    shared_session: Optional[Session] = None
+    failed = False
+
+    def wrap_handle(self, args, io, command) -> Optional[int]:
+        # Commands are reused between runs, so the login token and inventory are only kept for one invocation
+        self.session = self.shared_session or Session()
+        self.failed = False
+
+        try:
+            return super().wrap_handle(args, io, command)
+        finally:
+            if self.shared_session is None:
+                self.flush_config()
+
+    def line(self, text: str, style: str = None, verbosity=None) -> None:
+        # remembered so that `packagr batch` can tell which of its commands failed
+        if style == 'error' or text.startswith('<error>'):
+            self.failed = True
+        super().line(text, style, verbosity)
+
+    @property
+    def headers(self) -> dict:
+        if self.session.headers is None:
+            access_token = self.get_access_token()
+            self.session.headers = {
+                'Authorization': f'JWT {access_token}'
+            }
+        return self.session.headers
+
     @property
-    def headers(self):
-        access_token = self.get_access_token()
-        return {
-            'Authorization': f'JWT {access_token}'
-        }
+    def use_cache(self) -> bool:
+        return not self.option('no-cache')
+
+    @property
+    def registry(self) -> Registry:
+        if self.session.registry is None:
+            self.session.registry = Registry(
+                self.iter_packages,
+                self.iter_users,
+                self.iter_tokens,
+                find_package=lambda name: self.find(utilities.find_package, name),
+                find_user=lambda email: self.find(utilities.find_user, email),
+                find_token=lambda package, user: self.find(utilities.find_token, package, user),
+            )
+        return self.session.registry
+
+    def get_jobs(self, option: str = 'jobs') -> Optional[int]:
+        """
+        Returns the value of the `--jobs` option (or another one like it), or None (after printing an error) if it isn't
+        a positive number
+        """
+        try:
+            jobs = int(self.option(option))
+            assert jobs > 0
+        except (TypeError, ValueError, AssertionError):
+            self.line(f'<error>--{option} must be a positive number</error>')
+            return None
+
+        return jobs
 
     def get_access_token(self):
         token = utilities.get_access_token()
@@ -21,63 +105,76 @@ class Command(BaseCommand):
             self.line('<error>Unable to get login token from Packagr</error>')
             return None
 
-    def get_packages(self) -> Optional[List[Package]]:
-        packages = utilities.get_packages(headers=self.headers)
-
-        if not packages:
+    def listing(self, items: Iterator[Any], kind: str = None) -> Iterator[Any]:
+        """
+        Passes on the items of an API listing, printing an error (and stopping) if a page of it cannot be fetched. If
+        a `kind` is given, a listing that is read in full is kept in the inventory for later commands
+        """
+        read = []
+        try:
+            for item in items:
+                read.append(item)
+                yield item
+        except AssertionError:
             self.line('<error>Invalid status code</error>')
+            return
 
-        return packages
+        if kind:
+            inventory.set(kind, identity(self.headers), read)
 
-    def get_tokens(self) -> Optional[List[Token]]:
-        tokens = utilities.get_tokens(headers=self.headers)
+    def remembered(self, kind: str, iterate: Callable[..., Iterator[Any]]) -> Iterator[Any]:
+        """
+        Returns a listing kept in the inventory by an earlier command, or reads it from the API
+        """
+        if self.use_cache:
+            items = inventory.get(kind, identity(self.headers))
+            if items is not None:
+                return iter(items)
 
-        if not tokens:
-            self.line('<error>Invalid status code</error>')
+        return self.listing(iterate(headers=self.headers, use_cache=self.use_cache), kind)
 
-        return tokens
+    def find(self, finder: Callable[..., Optional[list]], *args) -> Optional[list]:
+        """
+        Looks something up with a filtered API request. If that fails, None is returned so that the whole listing is
+        looked through instead
+        """
+        try:
+            return finder(self.headers, *args)
+        except AssertionError:
+            return None
 
-    def get_users(self) -> Optional[List[User]]:
-        users = utilities.get_users(headers=self.headers)
+    def iter_packages(self) -> Iterator[Package]:
+        return self.remembered('packages', utilities.iter_packages)
 
-        if not users:
-            self.line('<error>Invalid status code</error>')
+    def iter_tokens(self) -> Iterator[Token]:
+        return self.remembered('tokens', utilities.iter_tokens)
 
-        return users
+    def iter_users(self) -> Iterator[User]:
+        return self.remembered('users', utilities.iter_users)
 
     def retrieve_package(self, name: str) -> Optional[Package]:
-        packages = self.get_packages()
+        package = self.registry.package(name)
 
-        if packages:
-            matching = list(filter(lambda x: x.name == name, packages))
-            if matching:
-                return matching[0]
+        if not package:
+            self.line('<error>Cannot find a package with that name</error>')
 
-        self.line('<error>Cannot find a package with that name</error>')
-        return None
+        return package
 
     def retrieve_token(self, package: Package, user: User) -> Optional[Token]:
-        tokens = self.get_tokens()
-
-        if tokens:
-            matching = list(filter(lambda x: x.package == package.uuid and x.user == user.hash_id, tokens))
+        token = self.registry.token(package, user)
 
-            if matching:
-                return matching[0]
+        if not token:
+            self.line('<error>Cannot find an access token for this user/package</error>')
 
-        self.line('<error>Cannot find an access token for this user/package</error>')
-        return None
+        return token
 
     def retrieve_user(self, email: str) -> Optional[User]:
-        users = self.get_users()
+        user = self.registry.user(email)
 
-        if users:
-            matching = list(filter(lambda x: x.email == email, users))
-            if matching:
-                return matching[0]
+        if not user:
+            self.line('<error>Cannot find a user with that email address</error>')
 
-        self.line('<error>Cannot find a user with that email address</error>')
-        return None
+        return user
 
     def create_access_token(self, package: Package, user: User, write_access: bool = False) -> bool:
         """
@@ -85,7 +182,10 @@ class Command(BaseCommand):
         """
         ok, error = utilities.create_access_token(self.headers, package, user, write_access)
 
-        if not ok:
+        if ok:
+            self.registry.invalidate_tokens()
+            inventory.invalidate('tokens')
+        else:
             self.line(f'<error>Could not create access token due to {error} error</error>')
 
         return ok
@@ -93,17 +193,58 @@ class Command(BaseCommand):
     def delete_access_token(self, token: Token) -> Optional[bool]:
         deleted, error = utilities.delete_access_token(token, self.headers)
 
-        if not deleted:
+        if deleted:
+            self.registry.invalidate_tokens()
+            inventory.invalidate('tokens')
+        else:
             self.line(f'<error>{error}</error>')
 
         return deleted
 
-    def check_configuration(self, hash_id: str, email: str, password: str) -> bool:
+    def call(self, args: List[str]) -> int:
+        """
+        Runs a subprocess, returning its exit code
         """
-        Check that a global config has been set with the `packagr configure` command
+        with timings.phase('subprocess', ' '.join(args)) as details:
+            details['returncode'] = subprocess.call(args)
+        return details['returncode']
+
+    def pip(self,
+            args: List[str],
+            packages: List[str],
+            ignore_errors: bool,
+            action: str,
+            requirements: Dict[str, str] = None) -> List[str]:
+        """
+        Runs a pip command (e.g. `install`) for all of the packages at once, returning the ones it succeeded for. If the
+        combined call fails, each package is retried on its own to find out which one is at fault. `requirements` can
+        replace what pip is given for some of the packages, e.g. a local file to install them from
+        """
+        command, options = args[0], args[1:]
+        requirements = requirements or {}
+
+        if self.call(['pip', command] + [requirements.get(package, package) for package in packages] + options) == 0:
+            return list(packages)
+
+        succeeded = []
+        for package in packages:
+            if len(packages) > 1 and self.call(['pip', command, requirements.get(package, package)] + options) == 0:
+                succeeded.append(package)
+            else:
+                self.line(f'<error>Error {action} package {package}.</error>')
+                if not ignore_errors:
+                    self.line('<error>Stopping process</error>')
+                    break
+
+        return succeeded
+
+    def check_configuration(self, hash_id: str, email: str, password: str, refresh: bool = False) -> bool:
+        """
+        Check that a global config has been set with the `packagr configure` command. `refresh` checks the credentials
+        with a fresh login rather than trusting a cached token
         """
         try:
-            return utilities.check_configuration(hash_id, email, password)
+            return utilities.check_configuration(hash_id, email, password, refresh)
         except AssertionError:
             self.line('<error>Invalid credentials</error>')
 
@@ -116,10 +257,21 @@ class Command(BaseCommand):
         """
         return self.get_package_config(path=os.path.expanduser('~/packagr_conf.toml'))
 
-    def get_package_config(self, path: str = 'packagr.toml') -> Optional[MutableMapping[str, Any]]:
-        config = utilities.get_package_config(path=path)
+    def get_package_config(self, path: str = 'packagr.toml',
+                           quiet: bool = False) -> Optional[MutableMapping[str, Any]]:
+        if path in self.session.config_changes:
+            # changed by an earlier command of the session, but not written yet
+            return copy.deepcopy(self.session.config_changes[path])
+
+        try:
+            config = utilities.get_package_config(path=path)
+        except FileNotFoundError:
+            config = None
+
+        if config and path not in self.session.config_bases:
+            self.session.config_bases[path] = copy.deepcopy(config)
 
-        if not config:
+        if not config and not quiet:
             self.line('<error>'
                       'Unable to perform this action because no package exists at the current location. '
                       'Run `packagr init` first'
@@ -127,9 +279,17 @@ class Command(BaseCommand):
 
         return config
 
-    @staticmethod
-    def write_package_content(config: dict, path: str = 'packagr.toml') -> None:
-        utilities.write_package_content(config, path=path)
+    def write_package_content(self, config: MutableMapping[str, Any], path: str = 'packagr.toml') -> None:
+        """
+        Queues a config file to be written. All changes made during a command are written at once when it finishes
+        """
+        self.session.config_changes[path] = config
+
+    def flush_config(self) -> None:
+        """
+        Writes the config files changed by the command (see `Session.flush`)
+        """
+        self.session.flush()
 
     def update_config(self, config, path: str = 'packagr.toml', **changes):
         for key, value in changes.items():
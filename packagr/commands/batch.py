@@ -0,0 +1,119 @@
+from clikit.api.exceptions import CliKitException
+from clikit.args import ArgvArgs
+from packagr.commands.base import Command, Session
+from packagr.commands.lazy import LazyCommand
+from typing import List, Optional, Tuple
+import shlex
+import sys
+
+
+class BatchCommand(Command):
+    """
+    Runs Packagr CLI commands from a file, one per line, in a single process
+
+    batch
+        {file? : A file of commands, e.g. `create-token my-package me@example.com`. Reads them from stdin if not given}
+        {--k|keep-going : Carry on with the remaining commands after one fails}
+    """
+    # commands that cannot be run as part of a batch
+    excluded = {'batch', 'agent'}
+
+    def handle(self) -> int:
+        path = self.argument('file')
+        try:
+            lines = self.read_lines(path)
+        except OSError as e:
+            self.line(f'<error>Cannot read {path}: {e.strerror}</error>')
+            return 1
+
+        session = Session()
+        interactive = self.io.is_interactive()
+        # there is nobody to answer questions, so they get their default answers
+        self.io.set_interactive(False)
+
+        ran, failed = 0, []
+        try:
+            for number, line in lines:
+                self.line(f'<comment>{number}: {line.strip()}</comment>')
+                try:
+                    status = self.run_line(self.split(line), session)
+                except ValueError as e:
+                    self.line(f'<error>Cannot read the command: {e}</error>')
+                    status = 1
+                ran += 1
+
+                if status:
+                    failed.append(number)
+                    self.line(f'<error>Line {number} failed with exit code {status}</error>')
+                    if not self.option('keep-going'):
+                        break
+        finally:
+            session.flush()
+            self.io.set_interactive(interactive)
+
+        remaining = len(lines) - ran
+        summary = f'Ran {ran} commands: {ran - len(failed)} succeeded, {len(failed)} failed'
+        if remaining:
+            summary += f', {remaining} not run. Use --keep-going to run the remaining commands after a failure'
+        self.line(f'<error>{summary}</error>' if failed else f'<info>{summary}</info>')
+
+        return 1 if failed else 0
+
+    def read_lines(self, path: Optional[str]) -> List[Tuple[int, str]]:
+        """
+        Returns the lines to run, with their line numbers. Blank lines and comments (starting with #) are skipped
+        """
+        if path and path != '-':
+            with open(path, 'r') as f:
+                text = f.read()
+        else:
+            text = sys.stdin.read()
+
+        return [
+            (number, line) for number, line in enumerate(text.splitlines(), start=1)
+            if line.strip() and not line.strip().startswith('#')
+        ]
+
+    @staticmethod
+    def split(line: str) -> List[str]:
+        """
+        Splits a line into arguments, as a shell would. A leading `packagr` is optional
+        """
+        tokens = shlex.split(line, comments=True)
+        return tokens[1:] if tokens[:1] == ['packagr'] else tokens
+
+    def run_line(self, tokens: List[str], session: Session) -> int:
+        """
+        Runs a command as part of the session, returning its exit code. A command that printed an error counts as
+        failed even if it didn't return an exit code
+        """
+        if not tokens:
+            return 0
+
+        try:
+            resolved = self.application.resolve_command(ArgvArgs(['packagr'] + tokens))
+        except CliKitException as e:
+            self.line(f'<error>{e}</error>')
+            return 1
+
+        if resolved.command.name in self.excluded:
+            self.line(f'<error>{resolved.command.name} cannot be run from a batch</error>')
+            return 1
+
+        handler = resolved.command.config.handler
+        command = handler.command if isinstance(handler, LazyCommand) else handler
+
+        if isinstance(command, Command):
+            command.shared_session = session
+        try:
+            status = resolved.command.handle(resolved.args, self.io)
+        except Exception as e:
+            self.line(f'<error>{type(e).__name__}: {e}</error>')
+            return 1
+        finally:
+            if isinstance(command, Command):
+                command.shared_session = None
+
+        if status:
+            return status
+        return 1 if isinstance(command, Command) and command.failed else 0
@@ -0,0 +1,79 @@
+import ast
+import importlib
+import importlib.util
+from typing import Dict, Optional
+from cleo import Command as BaseCommand
+from packagr.timings import profile, record, timings
+
+# class docstrings found in each module's source, so that each module is only parsed once
+_docstrings: Dict[str, Dict[str, Optional[str]]] = {}
+
+
+def read_docstrings(module: str) -> Dict[str, Optional[str]]:
+    """
+    Returns the docstrings of the top level classes in a module, without importing it
+    """
+    if module not in _docstrings:
+        docstrings: Dict[str, Optional[str]] = {}
+        spec = importlib.util.find_spec(module)
+
+        if spec and spec.origin and spec.origin.endswith('.py'):
+            with open(spec.origin, 'r') as f:
+                tree = ast.parse(f.read(), spec.origin)
+
+            for node in tree.body:
+                if isinstance(node, ast.ClassDef):
+                    docstrings[node.name] = ast.get_docstring(node, clean=False)
+
+        _docstrings[module] = docstrings
+
+    return _docstrings[module]
+
+
+class LazyCommand(BaseCommand):
+    """
+    Registers a command with the application without importing the module that defines it. The command's name and
+    signature are read from its class docstring in the module's source, and the module (along with its dependencies)
+    is only imported when the command is run
+    """
+
+    def __init__(self, module: str, name: str) -> None:
+        self.module = module
+        self.class_name = name
+        self._command: Optional[BaseCommand] = None
+        self.__doc__ = self.read_docstring()
+        super().__init__()
+
+    def read_docstring(self) -> Optional[str]:
+        docstrings = read_docstrings(self.module)
+
+        if self.class_name in docstrings:
+            return docstrings[self.class_name]
+
+        # the source isn't available, e.g. when installed as bytecode only
+        return self.command.__doc__
+
+    @property
+    def command(self) -> BaseCommand:
+        """
+        The actual command, which is imported and created the first time it is needed
+        """
+        if self._command is None:
+            module = importlib.import_module(self.module)
+            self._command = getattr(module, self.class_name)()
+            # the application isn't set yet when this is called from the constructor
+            application = getattr(self, '_application', None)
+            if application:
+                self._command.set_application(application)
+        return self._command
+
+    def set_application(self, application) -> None:
+        super().set_application(application)
+        if self._command is not None:
+            self._command.set_application(application)
+
+    def wrap_handle(self, args, io, command) -> Optional[int]:
+        with record(io, args.option('timings'), args.option('timings-file')), profile(args.option('profile')):
+            with timings.phase('import', self.module):
+                real = self.command
+            return real.wrap_handle(args, io, command)
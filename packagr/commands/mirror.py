@@ -0,0 +1,108 @@
+from packagr import utilities
+from packagr.commands.base import Command
+from packagr.mirror import Mirror, default_path
+from typing import Optional
+import json
+import os
+import time
+
+
+class SyncCommand(Command):
+    """
+    Copies your packages, users and access tokens to a local database, for use with `packagr query`
+
+    sync
+        {--f|full : Download everything again, rather than only what has changed since the last sync}
+        {--d|database= : The database to sync to. Defaults to one per account in ~/.packagr/mirror}
+    """
+
+    def handle(self) -> None:
+        config = self.get_global_config()
+
+        if not config:
+            self.line('<error>Global config not found</error>')
+            return
+
+        path = self.option('database') or default_path(config['hash-id'])
+        headers = self.headers
+        start = time.monotonic()
+
+        def get(url: str, etag: Optional[str]):
+            return utilities.send('get', url, headers=headers, extra_headers={'If-None-Match': etag} if etag else None)
+
+        with Mirror(path) as mirror:
+            try:
+                results = mirror.sync(get, full=self.option('full'))
+            except AssertionError as e:
+                self.line(f'<error>Sync failed: {e}</error>')
+                return
+
+        for table, result in results.items():
+            self.line(f'{table}: {result["count"]} ({result["changed"]} of {result["pages"]} pages changed, '
+                      f'{result["removed"]} removed)')
+
+        self.line(f'<info>Synced to {path} in {time.monotonic() - start:.1f}s</info>')
+
+
+class QueryCommand(Command):
+    """
+    Answers questions about who has access to what from the local copy made by `packagr sync`
+
+    query
+        {question : One of user-tokens, package-tokens, unread-packages or writers}
+        {name? : The email address (for user-tokens) or package name (for package-tokens and writers)}
+        {--d|database= : The database to read. Defaults to the one `packagr sync` writes for the account}
+        {--j|json : Print the results as JSON}
+    """
+    questions = ['user-tokens', 'package-tokens', 'unread-packages', 'writers']
+
+    def handle(self) -> None:
+        question = self.argument('question')
+        name = self.argument('name')
+
+        if question not in self.questions:
+            self.line(f'<error>Unknown question {question}. Use one of {", ".join(self.questions)}</error>')
+            return
+
+        if question == 'user-tokens' and not name:
+            self.line('<error>user-tokens needs an email address</error>')
+            return
+        if question == 'package-tokens' and not name:
+            self.line('<error>package-tokens needs a package name</error>')
+            return
+
+        path = self.option('database')
+        if not path:
+            config = self.get_global_config()
+            if not config:
+                self.line('<error>Global config not found</error>')
+                return
+            path = default_path(config['hash-id'])
+
+        if not os.path.exists(path):
+            self.line('<error>There is no local copy of your account yet. Run `packagr sync` first</error>')
+            return
+
+        with Mirror(path) as mirror:
+            if question == 'user-tokens':
+                rows = mirror.tokens_for_user(name)
+            elif question == 'package-tokens':
+                rows = mirror.tokens_for_package(name)
+            elif question == 'unread-packages':
+                rows = mirror.unread_packages()
+            else:
+                rows = mirror.writers(name)
+            synced = mirror.synced()
+
+        if self.option('json'):
+            self.line(json.dumps(rows))
+            return
+
+        for row in rows:
+            self.line('  '.join(
+                ('write' if value else 'read') if key == 'write_access' else str(value) for key, value in row.items()
+            ))
+
+        if synced:
+            self.line(f'<comment>{len(rows)} results, as of {time.strftime("%Y-%m-%d %H:%M", time.localtime(synced))}'
+                      f'</comment>')
@@ -1,11 +1,170 @@
+from packagr.artifacts import Artifact, verify_all
 from packagr.commands.base import Command
 from distutils import core as dist_core
-from packagr.utilities import get_package_config
+from packagr.cache import atomic_write
+from packagr.client import get_client
+from packagr.timings import timings
+from packagr.utilities import (format_size, get_existing_files, get_package_config, select_artifacts,
+                               source_fingerprint, upload_file)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import glob
+import json
 import os
-import requests
-from typing import List, Dict
+import shutil
+import time
+from typing import Any, List, Mapping, MutableMapping, Optional, Set, Tuple
 import setuptools #  DO NOT REMOVE THIS - IT IS IMPORTANT, EVEN THOUGH IT APPEARS TO NOT BE USED
 
+# what was built last time, so that unchanged packages aren't built again
+STATE_PATH = os.path.join('build', 'packagr-build.json')
+
+
+def build_format(config: dict, format_name: str, build_dir: str) -> Tuple[List[str], float, Optional[str]]:
+    """
+    Builds one format (e.g. `sdist`) of a package, using its own build, egg-info and dist folders so that it can run
+    at the same time as other formats. Returns the paths of the files built, the time taken and an error, if any
+    """
+    dist_dir = os.path.join(build_dir, 'dist')
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    os.makedirs(dist_dir)
+
+    options = {
+        'build': {'build_base': build_dir},
+        'egg_info': {'egg_base': build_dir},
+        format_name: {'dist_dir': dist_dir},
+    }
+
+    start = time.monotonic()
+    try:
+        dist_core.setup(**dict(config, script_args=[format_name], options=options))
+        error = None
+    except (Exception, SystemExit) as e:
+        error = str(e) or e.__class__.__name__
+
+    artifacts = sorted(os.path.join(dist_dir, name) for name in os.listdir(dist_dir))
+    return artifacts, time.monotonic() - start, error
+
+
+def build_format_in_new_process(config: dict,
+                                format_name: str,
+                                build_dir: str) -> Tuple[List[str], float, Optional[str]]:
+    """
+    Runs `build_format` in a process of its own. distutils and setuptools keep state between calls to `setup()` (e.g.
+    the commands they have imported and configured), so a process that builds one format or package after another
+    can leak one build into the next
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(build_format, config, format_name, build_dir).result()
+
+
+def plain(value: Any) -> Any:
+    """
+    Returns a copy of a parsed TOML value made of plain dicts and lists. toml parses inline tables (e.g.
+    `package_dir = {"" = "src"}`) into a class of its own that can't be pickled, so can't be sent to a worker process
+    """
+    if isinstance(value, Mapping):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def setup_config(package_config: MutableMapping[str, Any], formats: List[str]) -> dict:
+    output = {
+        'script_name': 'setup.py',
+        'script_args': formats
+    }
+
+    for key, value in package_config.items():
+        output[key] = plain(value)
+
+    return output
+
+
+def read_build_state() -> Optional[dict]:
+    """
+    Returns what was recorded about the last build, if anything
+    """
+    try:
+        with open(STATE_PATH, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def is_up_to_date(fingerprint: Optional[str], formats: List[str]) -> bool:
+    # without a fingerprint (a package folder is missing), there is no telling whether the sources changed
+    if fingerprint is None:
+        return False
+
+    state = read_build_state()
+
+    if not state or state.get('fingerprint') != fingerprint or state.get('formats') != formats:
+        return False
+
+    return all(os.path.exists(os.path.join('dist', artifact)) for artifact in state.get('artifacts', []))
+
+
+def clean_build_lib() -> None:
+    """
+    The build folders are kept between builds so that compiled extensions (in build/*/temp.*) can be reused, but python
+    files copied to build/*/lib would end up in the wheel even after they are deleted from the source
+    """
+    for path in glob.glob(os.path.join('build', '*', 'lib*')):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def move_to_dist(paths: List[str]) -> List[str]:
+    """
+    Moves built files into `dist`, returning their names
+    """
+    os.makedirs('dist', exist_ok=True)
+    for path in paths:
+        os.replace(path, os.path.join('dist', os.path.basename(path)))
+    return [os.path.basename(path) for path in paths]
+
+
+def write_build_state(fingerprint: Optional[str], formats: List[str], artifacts: List[str]) -> None:
+    state = {'fingerprint': fingerprint, 'formats': formats, 'artifacts': artifacts}
+    atomic_write(STATE_PATH, json.dumps(state).encode(), mode=0o644)
+
+
+def build_package(directory: str,
+                  formats: List[str],
+                  force: bool = False) -> Tuple[List[str], float, Optional[str], bool]:
+    """
+    Builds the package in `directory` the same way as `packagr package` does, but one format after another (each in
+    a fresh process), for a worker process that is one of several building different packages. Returns the names of
+    the files in its `dist` folder, the time taken, an error (if any) and whether the package was already up to date
+    """
+    os.chdir(directory)
+    start = time.monotonic()
+
+    try:
+        package_config = get_package_config()
+        fingerprint = source_fingerprint(package_config)
+    except (OSError, ValueError) as e:
+        return [], time.monotonic() - start, str(e), False
+
+    if not force and is_up_to_date(fingerprint, formats):
+        return (read_build_state() or {}).get('artifacts', []), time.monotonic() - start, None, True
+
+    clean_build_lib()
+    config = setup_config(package_config, formats)
+    artifacts: List[str] = []
+
+    for format_name in formats:
+        built, _, error = build_format_in_new_process(config, format_name, os.path.join('build', format_name))
+        if error:
+            return sorted(artifacts), time.monotonic() - start, f'{format_name}: {error}', False
+        artifacts.extend(move_to_dist(built))
+
+    artifacts.sort()
+    if artifacts:
+        write_build_state(fingerprint, formats, artifacts)
+
+    return artifacts, time.monotonic() - start, None, False
+
 
 class CreatePackage(Command):
     """
@@ -14,19 +173,46 @@ class CreatePackage(Command):
     package
         {--w|no-wheel : Don't create a wheel package}
         {--s|no-sdist : Don't create an sdist package}
+        {--f|force : Build the package even if nothing has changed since the last build}
     """
+    state_path = STATE_PATH
+
+    executor_class = ProcessPoolExecutor
+
     def create_config(self, formats: List[str]) -> dict:
-        config = get_package_config()
+        return setup_config(self.get_package_config() or {}, formats)
+
+    def build(self, formats: List[str]) -> Optional[List[str]]:
+        """
+        Builds each format in its own worker process and moves the results into `dist`. Returns the names of the files
+        built, or None if any format failed
+        """
+        config = self.create_config(formats)
+        artifacts: List[str] = []
+        failed = False
 
-        output = {
-            'script_name': 'setup.py',
-            'script_args': formats + ['clean', '--all',]
-        }
+        with self.executor_class(max_workers=len(formats)) as executor:
+            futures = {
+                executor.submit(build_format, config, format_name, os.path.join('build', format_name)): format_name
+                for format_name in formats
+            }
 
-        for key, value in config.items():
-            output[key] = value
+            for future in as_completed(futures):
+                name = futures[future]
+                built, elapsed, error = future.result()
+                timings.add('build', name, elapsed, error=error)
 
-        return output
+                if error:
+                    self.line(f'<error>Building {name} failed after {elapsed:.1f}s: {error}</error>')
+                    failed = True
+                    continue
+
+                artifacts.extend(move_to_dist(built))
+
+                self.line(f'<comment>Built {name} in {elapsed:.1f}s: '
+                          f'{", ".join(os.path.basename(path) for path in built)}</comment>')
+
+        return None if failed else sorted(artifacts)
 
     def handle(self) -> None:
         formats: list = ['bdist_wheel', 'sdist']
@@ -40,17 +226,102 @@ class CreatePackage(Command):
             self.line('<error>No formats to build!</error>')
             return
 
-        config = self.create_config(formats)
-        dist_core.setup(**config)
+        # under `packagr batch`, earlier commands may have changed the config without writing it yet. The build and
+        # its fingerprint go by the file, so it is brought up to date first
+        self.session.flush()
+        package_config = self.get_package_config()
+        if not package_config:
+            return
+
+        with timings.phase('build', 'fingerprint sources'):
+            fingerprint = source_fingerprint(package_config)
+
+        if not self.option('force') and is_up_to_date(fingerprint, formats):
+            self.line('<info>Package is up to date, nothing to build (use --force to rebuild it)</info>')
+            return
+
+        clean_build_lib()
+        artifacts = self.build(formats)
+
+        if artifacts is None:
+            self.line('<error>Package build failed</error>')
+            return
+
+        if artifacts:
+            write_build_state(fingerprint, formats, artifacts)
+
         self.line('<info>Package built</info>')
 
 
-class UploadPackage(Command):
+class Uploader(Command):
+    """
+    The parts of uploading built files that `upload` and `workspace --upload` share
+    """
+
+    def upload(self,
+               config: MutableMapping[str, Any],
+               package_config: MutableMapping[str, Any],
+               artifact: Artifact) -> Tuple[str, Optional[int], int, float, Optional[str]]:
+        """
+        Uploads a single file, along with its digests, returning its name, the response status code, its size, the
+        time taken and an error, if the request could not be made at all (e.g. the connection failed)
+        """
+        start = time.monotonic()
+        try:
+            response = upload_file(
+                config['hash-id'],
+                (config['email'], config['password']),
+                {
+                    'name': package_config['name'],
+                    'version': package_config['version'],
+                    'sha256_digest': artifact.sha256,
+                    'md5_digest': artifact.md5,
+                },
+                artifact.path
+            )
+            status_code = response.status_code
+
+            # if an upload was retried after the server failed to respond, the first attempt may have succeeded after
+            # all
+            if status_code == 409 and artifact.name in self.get_existing_files(package_config, [artifact]):
+                status_code = 201
+        except get_client().errors as e:
+            return artifact.name, None, artifact.size, time.monotonic() - start, f'{type(e).__name__}: {e}'
+
+        return artifact.name, status_code, artifact.size, time.monotonic() - start, None
+
+    def verify_artifacts(self, paths: List[str], jobs: int = None) -> List[Artifact]:
+        """
+        Computes the digests of the files to upload and checks that none of them are damaged, reporting the ones that
+        are
+        """
+        with timings.phase('verify', f'{len(paths)} files'):
+            artifacts = verify_all(paths, jobs)
+
+        for artifact in artifacts:
+            if not artifact.ok:
+                self.line(f'<error>File {artifact.name} is corrupt: {artifact.error}</error>')
+        return artifacts
+
+    def get_existing_files(self, package_config: MutableMapping[str, Any], artifacts: List[Artifact]) -> Set[str]:
+        """
+        Returns the names of the files whose exact content has already been uploaded to Packagr
+        """
+        # only verified files, which have a digest, are looked up
+        digests = {artifact.name: artifact.sha256 for artifact in artifacts if artifact.sha256}
+        existing = get_existing_files(self.headers, package_config['name'], package_config['version'], digests)
+        return existing or set()
+
+
+class UploadPackage(Uploader):
     """
     Uploads built packages to Packagr
 
     upload
         {--i|ignore-errors : Continue to the next file even if errors are encountered}
+        {--j|jobs=4 : The number of files to upload in parallel}
+        {--a|all : Upload every file in dist, not just the ones for the current version}
+        {--g|glob=* : Only upload files matching these patterns}
     """
 
     def handle(self) -> None:
@@ -64,44 +335,92 @@ class UploadPackage(Command):
                 if package_config:
                     ignore_errors = self.option('ignore-errors')
 
-                    upload_count = 0
+                    jobs = self.get_jobs()
+                    if not jobs:
+                        return
 
-                    for root, dirs, files in os.walk('dist'):
-                        if len(files) == 0:
+                    paths = select_artifacts(
+                        package_config['name'],
+                        str(package_config['version']),
+                        all_files=self.option('all'),
+                        patterns=self.option('glob')
+                    )
+
+                    if not paths:
+                        if select_artifacts('', '', all_files=True):
+                            self.line(f'<error>No files found for {package_config["name"]} '
+                                      f'{package_config["version"]}. Use --all to upload every file in dist</error>')
+                        else:
                             self.line('<error>Nothing to upload. Run `packagr build` first to build a package</error>')
-                            return
+                        return
+
+                    artifacts = self.verify_artifacts(paths)
+                    corrupt = [artifact for artifact in artifacts if not artifact.ok]
+                    if corrupt and not ignore_errors:
+                        self.line(f'<error>Nothing uploaded, as {len(corrupt)} files are corrupt. Rebuild them, or use '
+                                  f'--ignore-errors to upload the other files</error>')
+                        return
+                    artifacts = [artifact for artifact in artifacts if artifact.ok]
 
-                        for file in files:
-                            self.line(f'<comment>Attempting to upload file {file} to Packagr</comment>')
+                    existing = self.get_existing_files(package_config, artifacts) if artifacts else set()
+                    for artifact in artifacts:
+                        if artifact.name in existing:
+                            self.line(f'<comment>File {artifact.name} is already on Packagr, skipping</comment>')
+                    artifacts = [artifact for artifact in artifacts if artifact.name not in existing]
 
-                            _files = {'content': (file, open(os.path.join(root, file), 'rb'))}
+                    upload_count = 0
+                    upload_bytes = 0
+                    start = time.monotonic()
+
+                    cancelled = 0
+                    failed = False
+                    with ThreadPoolExecutor(max_workers=jobs) as executor:
+                        futures = []
+                        for artifact in artifacts:
+                            self.line(f'<comment>Attempting to upload file {artifact.name} to Packagr</comment>')
+                            futures.append(executor.submit(self.upload, config, package_config, artifact))
 
-                            headers: Dict[str, str] = {}
-                            response = requests.post(
-                                config['url'],
-                                auth=(config['email'], config['password']),
-                                data={'name': package_config['name'], 'version': package_config['version']},
-                                files=_files,
-                                headers=headers
-                            )
+                        # after a failure, the uploads that have started are still reported, so that it is clear
+                        # which files reached Packagr
+                        for future in as_completed(futures):
+                            if future.cancelled():
+                                continue
+                            file, status_code, size, elapsed, error = future.result()
+                            failure = error or f'Status code: {status_code}'
 
-                            try:
-                                assert response.status_code == 201
-                                self.line(f'<info>File {file} uploaded successfully')
+                            if status_code == 201:
+                                self.line(f'<info>File {file} uploaded successfully ({format_size(size)} in '
+                                          f'{elapsed:.1f}s)</info>')
                                 upload_count += 1
-                            except AssertionError:
+                                upload_bytes += size
+
+                            elif ignore_errors:
+                                self.line(f'<error>Package failed to upload. {failure}'
+                                          f'\nSkipping to the next file...</error>')
+                            else:
+                                self.line(f'<error>Package failed to upload. {failure}</error>')
+                                cancelled += len([f for f in futures if f.cancel()])
+                                failed = True
+
+                    if failed:
+                        if cancelled:
+                            self.line(f'<error>Cancelled {cancelled} pending uploads</error>')
+                        return
+
+                    elapsed = time.monotonic() - start
 
-                                if ignore_errors:
-                                    self.line(f'<error>Package failed to upload. Status code: {response.status_code}'
-                                              f'\nSkipping to the next file...</error>')
-                                else:
-                                    self.line(f'<error>Package failed to upload. Status code: {response.status_code}</error>')
-                                    return
+                    if existing:
+                        self.line(f'<info>Skipped {len(existing)} files that were already uploaded</info>')
 
                     if upload_count == 0:
-                        self.line('<error>No files uploaded</error>')
+                        if not artifacts and not corrupt:
+                            self.line('<info>Nothing new to upload</info>')
+                        else:
+                            self.line('<error>No files uploaded</error>')
                     else:
-                        self.line(f'<info>Uploaded {upload_count} files successfully</info>')
+                        self.line(f'<info>Uploaded {upload_count} files successfully '
+                                  f'({format_size(upload_bytes)} in {elapsed:.1f}s, '
+                                  f'{format_size(upload_bytes / max(elapsed, 0.001))}/s)</info>')
 
             else:
                 self.line('<error>Packagr credentials are invalid</error>')
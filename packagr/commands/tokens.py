@@ -1,4 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from packagr import utilities
+from packagr.client import get_client
 from packagr.commands.base import Command
+from packagr.objects import Package, User
+from packagr.registry import inventory
+from typing import List, Optional, Tuple
+import csv
+import sys
 
 
 class CreateToken(Command):
@@ -65,3 +73,110 @@ class DeleteToken(Command):
 
         else:
             self.line('<error>Cannot find a package with that name</error>')
+
+
+class CreateTokens(Command):
+    """
+    Create access tokens for every combination of the given packages and users
+
+    create-tokens
+        {--p|package=* : A package to create access tokens for. Can be given more than once}
+        {--e|email=* : The email address of a user to create access tokens for. Can be given more than once}
+        {--f|file= : A CSV file of package,email pairs to create access tokens for. Use - to read from stdin}
+        {--w|write-access : Whether to give the users write access. By default, read-only access is granted}
+        {--j|jobs=4 : The number of access tokens to create in parallel}
+    """
+    # each pair needs up to three lookups, so beyond a few pairs it is cheaper to read the listings once
+    filter_limit = 3
+
+    def read_pairs(self) -> Optional[List[Tuple[str, str]]]:
+        """
+        Returns the (package name, email) pairs requested through the options and the CSV file
+        """
+        pairs = [(package, email) for package in self.option('package') for email in self.option('email')]
+
+        path = self.option('file')
+        if path:
+            try:
+                if path == '-':
+                    rows = list(csv.reader(sys.stdin))
+                else:
+                    with open(path, 'r', newline='') as f:
+                        rows = list(csv.reader(f))
+            except OSError as e:
+                self.line(f'<error>Cannot read {path}: {e.strerror}</error>')
+                return None
+
+            for row in rows:
+                row = [value.strip() for value in row]
+                if not any(row) or [value.lower() for value in row] == ['package', 'email']:
+                    continue
+                if len(row) != 2:
+                    self.line(f'<error>Invalid row {",".join(row)}: expected package,email</error>')
+                    return None
+                pairs.append((row[0], row[1]))
+
+        # remove duplicates but keep the order
+        return list(dict.fromkeys(pairs))
+
+    def handle(self) -> None:
+        write_access = self.option('write-access')
+        jobs = self.get_jobs()
+        if not jobs:
+            return
+
+        pairs = self.read_pairs()
+        if pairs is None:
+            return
+        if not pairs:
+            self.line('<error>No packages and users given. Use --package and --email, or --file</error>')
+            return
+
+        registry = self.registry
+        registry.use_filters = len(pairs) <= self.filter_limit
+        headers = self.headers
+        failed = 0
+        to_create: List[Tuple[Package, User]] = []
+
+        for package_name, email in pairs:
+            package = registry.package(package_name)
+            user = registry.user(email)
+
+            if not package:
+                self.line(f'<error>{package_name} / {email}: cannot find a package with that name</error>')
+                failed += 1
+            elif not user:
+                self.line(f'<error>{package_name} / {email}: cannot find a user with that email</error>')
+                failed += 1
+            elif registry.token(package, user):
+                self.line(f'<comment>{package_name} / {email}: access token already exists, skipping</comment>')
+            else:
+                to_create.append((package, user))
+
+        created = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(utilities.create_access_token, headers, package, user, write_access): (package, user)
+                for package, user in to_create
+            }
+
+            for future in as_completed(futures):
+                package, user = futures[future]
+                try:
+                    ok, error = future.result()
+                    reason = f'{error} error'
+                except get_client().errors as e:
+                    ok, reason = False, f'{type(e).__name__}: {e}'
+
+                if ok:
+                    self.line(f'<info>{package} / {user}: access token created</info>')
+                    created += 1
+                else:
+                    self.line(f'<error>{package} / {user}: could not create access token due to {reason}</error>')
+                    failed += 1
+
+        if to_create:
+            registry.invalidate_tokens()
+            inventory.invalidate('tokens')
+
+        self.line(f'Created {created} access tokens, skipped {len(pairs) - created - failed}, {failed} failed')
@@ -0,0 +1,194 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from packagr.artifacts import verify_all
+from packagr.commands.packaging import Uploader, build_package
+from packagr.workspace import Member, Workspace, discover
+from typing import Any, Dict, List, MutableMapping, Optional, Set, Tuple
+import os
+
+
+class WorkspaceCommand(Uploader):
+    """
+    Builds (and optionally uploads) every package in a folder and its subfolders, in order of their dependencies
+
+    workspace
+        {root? : The folder to look for packages (folders with a packagr.toml) in. Defaults to the current folder}
+        {--u|upload : Upload each package once it has been built, after the packages it depends on}
+        {--j|jobs= : The number of packages to build at once. Defaults to the number of CPUs}
+        {--upload-jobs=4 : The number of packages to upload at once}
+        {--w|no-wheel : Don't create wheel packages}
+        {--s|no-sdist : Don't create sdist packages}
+        {--f|force : Build every package, even the ones that haven't changed since they were last built}
+    """
+    executor_class = ProcessPoolExecutor
+
+    def handle(self) -> int:
+        root = self.argument('root') or '.'
+
+        formats = ['bdist_wheel', 'sdist']
+        if self.option('no-wheel'):
+            formats.remove('bdist_wheel')
+        if self.option('no-sdist'):
+            formats.remove('sdist')
+        if not formats:
+            self.line('<error>No formats to build!</error>')
+            return 1
+
+        jobs = self.get_jobs() if self.option('jobs') else os.cpu_count() or 1
+        upload_jobs = self.get_jobs('upload-jobs')
+        if not jobs or not upload_jobs:
+            return 1
+
+        try:
+            workspace = Workspace(discover(root))
+            order = workspace.order()
+        except ValueError as e:
+            self.line(f'<error>{e}</error>')
+            return 1
+
+        if not order:
+            self.line(f'<error>No packages found in {root}</error>')
+            return 1
+
+        config = None
+        if self.option('upload'):
+            config = self.get_global_config()
+            if not config:
+                self.line('<error>Global config not found</error>')
+                return 1
+            if not self.check_configuration(config['hash-id'], config['email'], config['password']):
+                self.line('<error>Packagr credentials are invalid</error>')
+                return 1
+            # logged in before the uploads start, rather than by each of them
+            self.headers
+
+        self.line(f'Found {len(order)} packages: {", ".join(order)}')
+        results = self.run_workspace(workspace, formats, jobs, upload_jobs, config)
+
+        self.render_table(
+            ['Package', 'Version', 'Path', 'Build'] + (['Upload'] if config else []),
+            [
+                [name, workspace.members[name].version, os.path.relpath(workspace.members[name].path, root),
+                 results[name]['build']] + ([results[name]['upload']] if config else [])
+                for name in order
+            ]
+        )
+
+        failed = [name for name in order if not results[name]['ok']]
+        if failed:
+            self.line(f'<error>{len(failed)} of {len(order)} packages failed or were skipped</error>')
+            return 1
+
+        self.line(f'<info>All {len(order)} packages done</info>')
+        return 0
+
+    def run_workspace(self,
+                      workspace: Workspace,
+                      formats: List[str],
+                      jobs: int,
+                      upload_jobs: int,
+                      config: Optional[MutableMapping[str, Any]]) -> Dict[str, dict]:
+        """
+        Builds each package in a worker process as soon as the packages it depends on have been built, and uploads it
+        (through the shared HTTP connection pool) as soon as they have been uploaded. Returns a summary of what
+        happened to each package
+        """
+        results = {name: {'build': 'skipped', 'upload': 'skipped', 'ok': False} for name in workspace.members}
+        artifacts: Dict[str, List[str]] = {}
+        built: Set[str] = set()
+        uploaded: Set[str] = set()
+        started_builds: Set[str] = set()
+        started_uploads: Set[str] = set()
+        futures: Dict[Future, Tuple[str, str]] = {}
+
+        with self.executor_class(max_workers=jobs) as builds, ThreadPoolExecutor(max_workers=upload_jobs) as uploads:
+            def schedule() -> None:
+                for name in workspace.ready(built, started_builds):
+                    started_builds.add(name)
+                    member = workspace.members[name]
+                    build = builds.submit(build_package, os.path.abspath(member.path), formats, self.option('force'))
+                    futures[build] = 'build', name
+
+                if config is None:
+                    return
+
+                for name in workspace.ready(uploaded, started_uploads):
+                    if name in built:
+                        started_uploads.add(name)
+                        upload = uploads.submit(self.upload_member, config, workspace.members[name], artifacts[name])
+                        futures[upload] = 'upload', name
+
+            schedule()
+            while futures:
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    kind, name = futures.pop(future)
+                    result = results[name]
+
+                    if kind == 'build':
+                        try:
+                            names, elapsed, error, up_to_date = future.result()
+                        except Exception as e:
+                            names, elapsed, error, up_to_date = [], 0.0, str(e) or e.__class__.__name__, False
+
+                        if error:
+                            result['build'] = 'failed'
+                            self.line(f'<error>{name}: build failed after {elapsed:.1f}s: {error}</error>')
+                            continue
+
+                        built.add(name)
+                        artifacts[name] = names
+                        result['build'] = 'up to date' if up_to_date else f'built in {elapsed:.1f}s'
+                        result['ok'] = config is None
+                        self.line(f'<comment>{name}: {result["build"]} ({", ".join(names) or "no files"})</comment>')
+
+                    else:
+                        try:
+                            count, skipped, error = future.result()
+                        except Exception as e:
+                            count, skipped, error = 0, 0, str(e) or e.__class__.__name__
+
+                        if error:
+                            result['upload'] = 'failed'
+                            self.line(f'<error>{name}: upload failed: {error}</error>')
+                            continue
+
+                        uploaded.add(name)
+                        result['upload'] = f'{count} uploaded' + (f', {skipped} already there' if skipped else '')
+                        result['ok'] = True
+                        self.line(f'<info>{name}: {result["upload"]}</info>')
+
+                schedule()
+
+        return results
+
+    def upload_member(self,
+                      config: MutableMapping[str, Any],
+                      member: Member,
+                      artifacts: List[str]) -> Tuple[int, int, Optional[str]]:
+        """
+        Uploads the files built for a package that aren't on Packagr already, unless any of them are corrupt. Returns
+        the number uploaded, the number skipped and an error, if any
+        """
+        verified = verify_all([os.path.join(member.path, 'dist', name) for name in artifacts], 1)
+        corrupt = [artifact for artifact in verified if not artifact.ok]
+        if corrupt:
+            return 0, 0, f'{corrupt[0].name} is corrupt: {corrupt[0].error}'
+
+        package_config = {'name': member.config.get('name', member.name), 'version': member.version}
+
+        existing = self.get_existing_files(package_config, verified) if verified else set()
+        count = 0
+
+        for artifact in verified:
+            if artifact.name in existing:
+                continue
+
+            name, status_code, _, _, error = self.upload(config, package_config, artifact)
+            if error:
+                return count, len(existing), f'{name} failed to upload: {error}'
+            if status_code != 201:
+                return count, len(existing), f'{name} failed to upload with status code {status_code}'
+            count += 1
+
+        return count, len(existing), None
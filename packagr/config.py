@@ -0,0 +1,132 @@
+import contextlib
+import copy
+import hashlib
+import os
+import toml
+from typing import Any, Dict, Iterator, MutableMapping, Optional, Tuple
+from packagr.cache import CACHE_DIR, atomic_write
+from packagr.timings import timings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None  # type: ignore
+
+_missing = object()
+
+
+def merge(base: MutableMapping[str, Any],
+          ours: MutableMapping[str, Any],
+          theirs: MutableMapping[str, Any]) -> MutableMapping[str, Any]:
+    """
+    Applies the changes made between `base` and `ours` on top of `theirs`, a version of the same config that has been
+    changed by someone else in the meantime. Values added to or removed from arrays are merged item by item, so that
+    e.g. two processes installing different packages at the same time both end up in `install_requires`
+    """
+    result = copy.deepcopy(theirs)
+
+    for key in set(base) | set(ours):
+        old, new = base.get(key, _missing), ours.get(key, _missing)
+
+        if new is _missing:
+            result.pop(key, None)
+        elif old == new:
+            continue
+        elif isinstance(old, list) and isinstance(new, list) and isinstance(result.get(key), list):
+            merged = [value for value in result[key] if value in new or value not in old]
+            merged.extend(value for value in new if value not in old and value not in merged)
+            result[key] = merged
+        else:
+            result[key] = new
+
+    return result
+
+
+class ConfigStore(object):
+    """
+    Reads and writes TOML config files. Parsed files are cached for the lifetime of the process, keyed by path and
+    modification time, so a file is only parsed again if it changes. Writes are atomic (a temporary file is renamed
+    into place) and made while holding an advisory lock, so that parallel processes neither corrupt the file nor lose
+    each other's changes
+    """
+    def __init__(self, lock_dir: str = None) -> None:
+        self._cache: Dict[str, Tuple[Tuple[int, int, int], MutableMapping[str, Any]]] = {}
+        self.lock_dir = lock_dir or os.path.join(CACHE_DIR, 'locks')
+
+    @staticmethod
+    def stamp(path: str) -> Tuple[int, int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def load(self, path: str) -> MutableMapping[str, Any]:
+        """
+        Returns the content of a config file. Raises FileNotFoundError if it doesn't exist
+        """
+        path = os.path.abspath(path)
+        stamp = self.stamp(path)
+        cached = self._cache.get(path)
+
+        if cached and cached[0] == stamp:
+            config = cached[1]
+            timings.add('config', f'read {path}', 0, cached=True)
+        else:
+            with timings.phase('config', f'read {path}'):
+                with open(path, 'r') as f:
+                    config = toml.loads(f.read())
+            self._cache[path] = stamp, config
+
+        # callers are free to change what they get back, so they get a copy
+        return copy.deepcopy(config)
+
+    @contextlib.contextmanager
+    def lock(self, path: str) -> Iterator[None]:
+        """
+        Holds an exclusive advisory lock for a config file. The lock is taken on a separate file, because writes
+        replace the config file itself. Lock files are kept in the cache folder, named after the config file's path,
+        rather than left next to it
+        """
+        if fcntl is None:
+            yield
+            return
+
+        key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+        os.makedirs(self.lock_dir, mode=0o700, exist_ok=True)
+        with open(os.path.join(self.lock_dir, f'{key}.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def save(self,
+             path: str,
+             config: MutableMapping[str, Any],
+             base: Optional[MutableMapping[str, Any]] = None) -> MutableMapping[str, Any]:
+        """
+        Writes a config file. If `base` (the content `config` was based on) is given and the file has been changed by
+        someone else since, the changes are merged into the current content rather than overwriting it. Returns what
+        was written
+        """
+        path = os.path.abspath(path)
+
+        with timings.phase('config', f'write {path}'), self.lock(path):
+            if base is not None:
+                try:
+                    current = self.load(path)
+                except FileNotFoundError:
+                    current = None
+                if current is not None and current != base:
+                    config = merge(base, config, current)
+
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+
+            atomic_write(path, toml.dumps(config).encode(), mode=mode)
+            self._cache[path] = self.stamp(path), copy.deepcopy(config)
+
+        return config
+
+
+store = ConfigStore()
@@ -0,0 +1,199 @@
+import json
+import os
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    import requests
+
+MIRROR_DIR = os.environ.get('PACKAGR_MIRROR_DIR', os.path.expanduser('~/.packagr/mirror'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (uuid TEXT PRIMARY KEY, name TEXT NOT NULL, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (hash_id TEXT PRIMARY KEY, email TEXT NOT NULL, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tokens (
+    uuid TEXT PRIMARY KEY,
+    package TEXT NOT NULL,
+    user TEXT NOT NULL,
+    write_access INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    listing TEXT NOT NULL,
+    etag TEXT,
+    next TEXT,
+    ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS tokens_package ON tokens (package);
+CREATE INDEX IF NOT EXISTS tokens_user ON tokens (user);
+"""
+
+# the API listing each table is mirrored from, and the field that identifies its rows
+LISTINGS = {
+    'packages': ('api/v1/packages/', 'uuid'),
+    'users': ('api/v1/subusers/', 'hash_id'),
+    'tokens': ('api/v1/tokens/', 'uuid'),
+}
+
+
+def default_path(hash_id: str) -> str:
+    return os.path.join(MIRROR_DIR, f'{hash_id}.sqlite3')
+
+
+class Mirror(object):
+    """
+    A local copy of an account's packages, users and access tokens in an indexed SQLite database, so that questions
+    about who has access to what can be answered without asking Packagr. Each page of each listing is stored along
+    with its ETag, so that syncing again only downloads the pages that have changed
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # the mirror lists the account's users and who has access to what, so only its owner can read it. SQLite gives
+        # its journal files the same permissions as the database
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> 'Mirror':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def upsert(self, table: str, items: List[Dict[str, Any]]) -> None:
+        rows: List[tuple]
+        if table == 'packages':
+            rows = [(item['uuid'], item['name'], json.dumps(item)) for item in items]
+            self.db.executemany('INSERT OR REPLACE INTO packages VALUES (?, ?, ?)', rows)
+        elif table == 'users':
+            rows = [(item['hash_id'], item['email'], json.dumps(item)) for item in items]
+            self.db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', rows)
+        else:
+            rows = [
+                (item['uuid'], item['package'], item['user'], bool(item.get('write_access')), json.dumps(item))
+                for item in items
+            ]
+            self.db.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?)', rows)
+
+    def sync_listing(self,
+                     table: str,
+                     get: Callable[[str, Optional[str]], 'requests.Response'],
+                     full: bool = False) -> Dict[str, int]:
+        """
+        Brings a table up to date with its listing. `get` makes a GET request for a url, conditional on the ETag given
+        (if any). Pages the server says haven't changed keep their rows, and rows that are no longer listed are removed.
+        Raises AssertionError if a page cannot be fetched
+        """
+        path, key = LISTINGS[table]
+        stored = {row['url']: row for row in self.db.execute('SELECT * FROM pages WHERE listing = ?', (table,))}
+        seen_ids: List[str] = []
+        seen_urls: List[str] = []
+        changed = 0
+
+        url: Optional[str] = path
+        while url:
+            page = stored.get(url)
+            response = get(url, page['etag'] if page and not full else None)
+
+            if response.status_code == 304 and page:
+                ids, next_url = json.loads(page['ids']), page['next']
+            else:
+                assert response.status_code == 200, f'Unexpected status code {response.status_code}'
+                content = response.json()
+                if isinstance(content, list):
+                    items, next_url = content, None
+                else:
+                    items, next_url = content.get('results', []), content.get('next')
+
+                self.upsert(table, items)
+                ids = [item[key] for item in items]
+                self.db.execute(
+                    'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                    (url, table, response.headers.get('ETag'), next_url, json.dumps(ids))
+                )
+                changed += 1
+
+            seen_ids.extend(ids)
+            seen_urls.append(url)
+            url = next_url
+
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM seen')
+        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(id_,) for id_ in seen_ids])
+        removed = self.db.execute(f'DELETE FROM {table} WHERE {key} NOT IN (SELECT id FROM seen)').rowcount
+
+        self.db.execute('DELETE FROM seen')
+        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(url,) for url in seen_urls])
+        self.db.execute('DELETE FROM pages WHERE listing = ? AND url NOT IN (SELECT id FROM seen)', (table,))
+
+        return {'count': len(set(seen_ids)), 'pages': len(seen_urls), 'changed': changed, 'removed': removed}
+
+    def sync(self,
+             get: Callable[[str, Optional[str]], 'requests.Response'],
+             full: bool = False) -> Dict[str, Dict[str, int]]:
+        """
+        Syncs every table in a single transaction, so the database is left as it was if any page cannot be fetched
+        """
+        with self.db:
+            results = {table: self.sync_listing(table, get, full=full) for table in LISTINGS}
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('synced', str(time.time())))
+        return results
+
+    def synced(self) -> Optional[float]:
+        """
+        Returns when the database was last synced, if ever
+        """
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', ('synced',)).fetchone()
+        return float(row['value']) if row else None
+
+    def query(self, sql: str, *params: Any) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+    def tokens_for_user(self, email: str) -> List[Dict[str, Any]]:
+        return self.query(
+            'SELECT packages.name AS package, tokens.write_access AS write_access FROM tokens '
+            'JOIN users ON users.hash_id = tokens.user '
+            'LEFT JOIN packages ON packages.uuid = tokens.package '
+            'WHERE users.email = ? ORDER BY packages.name',
+            email
+        )
+
+    def tokens_for_package(self, name: str) -> List[Dict[str, Any]]:
+        return self.query(
+            'SELECT users.email AS email, tokens.write_access AS write_access FROM tokens '
+            'JOIN packages ON packages.uuid = tokens.package '
+            'LEFT JOIN users ON users.hash_id = tokens.user '
+            'WHERE packages.name = ? ORDER BY users.email',
+            name
+        )
+
+    def unread_packages(self) -> List[Dict[str, Any]]:
+        """
+        Returns the packages that no user has an access token for
+        """
+        return self.query(
+            'SELECT packages.name AS package FROM packages '
+            'WHERE NOT EXISTS (SELECT 1 FROM tokens WHERE tokens.package = packages.uuid) ORDER BY packages.name'
+        )
+
+    def writers(self, name: str = None) -> List[Dict[str, Any]]:
+        """
+        Returns the users with write access, to every package or to the given one
+        """
+        return self.query(
+            'SELECT packages.name AS package, users.email AS email FROM tokens '
+            'JOIN packages ON packages.uuid = tokens.package '
+            'JOIN users ON users.hash_id = tokens.user '
+            'WHERE tokens.write_access AND (? IS NULL OR packages.name = ?) ORDER BY packages.name, users.email',
+            name, name
+        )
@@ -0,0 +1,106 @@
+import os
+import uuid
+from typing import BinaryIO, Iterator, List, Mapping, Optional, Union
+
+
+class MultipartEncoder(object):
+    """
+    A multipart/form-data request body that streams a file from disk in fixed-size chunks, rather than loading it into
+    memory. The total length is known up front, so requests sends it with a Content-Length header
+
+    Use it as a context manager so that the file handle is closed once the request is done
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, fields: Mapping[str, str], file_field: str, path: str, chunk_size: int = None) -> None:
+        self.path = path
+        self.boundary = uuid.uuid4().hex
+        if chunk_size:
+            self.chunk_size = chunk_size
+
+        filename = os.path.basename(path).replace('"', '%22')
+        self.parts: List[Union[bytes, str]] = []
+        for name, value in fields.items():
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        self.parts.append(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+        )
+        self.parts.append(path)
+        self.parts.append(f'\r\n--{self.boundary}--\r\n'.encode())
+
+        self.length = sum(len(part) for part in self.parts if isinstance(part, bytes)) + os.path.getsize(path)
+        self._index = 0
+        self._offset = 0
+        self._file: Optional[BinaryIO] = None
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __enter__(self) -> 'MultipartEncoder':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to `size` bytes of the body. A negative size reads in chunks of `chunk_size`, so that the whole body
+        is never held in memory at once
+        """
+        if size is None or size < 0:
+            size = self.chunk_size
+
+        chunks = []
+        remaining = size
+
+        while remaining > 0 and self._index < len(self.parts):
+            part = self.parts[self._index]
+
+            if isinstance(part, bytes):
+                chunk = part[self._offset:self._offset + remaining]
+                self._offset += len(chunk)
+                if self._offset >= len(part):
+                    self._next_part()
+            else:
+                if self._file is None:
+                    self._file = open(part, 'rb')
+                chunk = self._file.read(remaining)
+                if len(chunk) < remaining:
+                    self.close()
+                    self._next_part()
+
+            chunks.append(chunk)
+            remaining -= len(chunk)
+
+        return b''.join(chunks)
+
+    def _next_part(self) -> None:
+        self._index += 1
+        self._offset = 0
+
+    def rewind(self) -> None:
+        """
+        Resets the body so that it can be sent again
+        """
+        self.close()
+        self._index = 0
+        self._offset = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
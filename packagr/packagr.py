@@ -1,28 +1,58 @@
 #!/usr/bin/env python3
 
 from cleo import Application
-from packagr.commands import admin, packaging, tokens
-
-
-application = Application()
-
-# admin
-application.add(admin.CreatePackage())
-application.add(admin.ConfigureClient())
-application.add(admin.SetValue())
-application.add(admin.AddValue())
-application.add(admin.RemoveValue())
-application.add(admin.InstallCommand())
-application.add(admin.UninstallCommand())
-application.add(admin.BumpVersion())
-
-# package
-application.add(packaging.CreatePackage())
-application.add(packaging.UploadPackage())
-
-# tokens
-application.add(tokens.CreateToken())
-application.add(tokens.DeleteToken())
+from cleo.config import ApplicationConfig
+from clikit.api.args.format import Option
+from packagr.commands.lazy import LazyCommand
+
+
+config = ApplicationConfig()
+config.add_option('no-cache', None, Option.NO_VALUE, 'Ignore cached responses from the Packagr API')
+config.add_option('timings', None, Option.NO_VALUE, 'Show how long each step of the command took')
+config.add_option('timings-file', None, Option.REQUIRED_VALUE, 'Write how long each step took to a JSON file')
+config.add_option('profile', None, Option.REQUIRED_VALUE, 'Profile the command and write the stats to a file')
+
+application = Application(config=config)
+
+# Commands are only imported when they are run, so that e.g. `packagr bump` doesn't have to import setuptools
+commands = {
+    'packagr.commands.admin': [
+        'CreatePackage',
+        'ConfigureClient',
+        'SetValue',
+        'AddValue',
+        'RemoveValue',
+        'InstallCommand',
+        'UninstallCommand',
+        'BumpVersion',
+    ],
+    'packagr.commands.packaging': [
+        'CreatePackage',
+        'UploadPackage',
+    ],
+    'packagr.commands.tokens': [
+        'CreateToken',
+        'DeleteToken',
+        'CreateTokens',
+    ],
+    'packagr.commands.mirror': [
+        'SyncCommand',
+        'QueryCommand',
+    ],
+    'packagr.commands.agent': [
+        'AgentCommand',
+    ],
+    'packagr.commands.batch': [
+        'BatchCommand',
+    ],
+    'packagr.commands.workspace': [
+        'WorkspaceCommand',
+    ],
+}
+
+for module, names in commands.items():
+    for name in names:
+        application.add(LazyCommand(module, name))
 
 
 def run():
@@ -0,0 +1,215 @@
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from packagr.cache import CACHE_TTL
+from packagr.objects import Package, Token, User
+
+T = TypeVar('T')
+
+
+class Listing(Generic[T]):
+    """
+    A listing of objects that is read from its source (e.g. a paginated API endpoint) only as far as needed. Objects
+    are passed to `index` as they are read, and kept so that later lookups don't read them again
+    """
+    def __init__(self, fetch: Callable[[], Optional[Iterable[T]]], index: Callable[[T], None]) -> None:
+        self.fetch = fetch
+        self.index = index
+        self.items: List[T] = []
+        self.source: Optional[Iterator[T]] = None
+        self.complete = False
+
+    @property
+    def started(self) -> bool:
+        return self.source is not None or self.complete
+
+    def read(self) -> bool:
+        """
+        Reads the next object from the source, returning False if there are no more
+        """
+        if self.complete:
+            return False
+
+        if self.source is None:
+            items = self.fetch()
+            if items is None:
+                # the listing could not be fetched, so it will be tried again next time
+                return False
+            self.source = iter(items)
+
+        for item in self.source:
+            self.items.append(item)
+            self.index(item)
+            return True
+
+        self.complete = True
+        return False
+
+    def read_until(self, found: Callable[[], bool]) -> bool:
+        """
+        Reads objects until `found` returns True or there are no more, returning whether it was found
+        """
+        while not found():
+            if not self.read():
+                return False
+        return True
+
+    def read_all(self) -> List[T]:
+        while self.read():
+            pass
+        return self.items
+
+
+class Registry(object):
+    """
+    Indexes the packages, users and access tokens of an account for constant time lookups. Each listing is read
+    (through the given callables, which return iterables) only as far as needed to find what is being looked up, and
+    what has been read is reused by later lookups.
+
+    If `find_*` callables are given, single lookups are made with them instead (e.g. through a filtered API request)
+    until the listing has been read. They return the matches, or None if they can't be used, in which case the listing
+    is read instead. Set `use_filters` to False to always read the listings, e.g. when looking up many objects
+    """
+    def __init__(self,
+                 get_packages: Callable[[], Optional[Iterable[Package]]],
+                 get_users: Callable[[], Optional[Iterable[User]]],
+                 get_tokens: Callable[[], Optional[Iterable[Token]]],
+                 find_package: Callable[[str], Optional[List[Package]]] = None,
+                 find_user: Callable[[str], Optional[List[User]]] = None,
+                 find_token: Callable[[Package, User], Optional[List[Token]]] = None) -> None:
+        self.find_package = find_package
+        self.find_user = find_user
+        self.find_token = find_token
+        self.use_filters = True
+        self.found: Dict[tuple, Optional[object]] = {}
+
+        self.packages_by_name: Dict[str, Package] = {}
+        self.packages_by_uuid: Dict[str, Package] = {}
+        self.users_by_email: Dict[str, User] = {}
+        self.users_by_hash_id: Dict[str, User] = {}
+        self.tokens_by_pair: Dict[Tuple[str, str], Token] = {}
+        self.tokens_by_package: Dict[str, List[Token]] = defaultdict(list)
+        self.tokens_by_user: Dict[str, List[Token]] = defaultdict(list)
+
+        self._get_tokens = get_tokens
+        self._packages: Listing[Package] = Listing(get_packages, self.index_package)
+        self._users: Listing[User] = Listing(get_users, self.index_user)
+        self._tokens: Listing[Token] = Listing(get_tokens, self.index_token)
+
+    def index_package(self, package: Package) -> None:
+        self.packages_by_name.setdefault(package.name, package)
+        self.packages_by_uuid[package.uuid] = package
+
+    def index_user(self, user: User) -> None:
+        self.users_by_email.setdefault(user.email, user)
+        self.users_by_hash_id[user.hash_id] = user
+
+    def index_token(self, token: Token) -> None:
+        self.tokens_by_pair.setdefault((token.package, token.user), token)
+        self.tokens_by_package[token.package].append(token)
+        self.tokens_by_user[token.user].append(token)
+
+    @property
+    def packages(self) -> List[Package]:
+        return self._packages.read_all()
+
+    @property
+    def users(self) -> List[User]:
+        return self._users.read_all()
+
+    @property
+    def tokens(self) -> List[Token]:
+        return self._tokens.read_all()
+
+    def find(self, listing: Listing, finder: Optional[Callable[..., Optional[list]]], key: tuple, *args) -> bool:
+        """
+        Looks an object up with a finder, if one can be used, keeping the result in `found`. Returns False if the
+        listing has to be read instead
+        """
+        if key in self.found:
+            return True
+        if not finder or not self.use_filters or listing.started:
+            return False
+
+        matches = finder(*args)
+        if matches is None:
+            return False
+
+        self.found[key] = matches[0] if matches else None
+        return True
+
+    def package(self, name: str) -> Optional[Package]:
+        if name not in self.packages_by_name and self.find(self._packages, self.find_package, ('package', name), name):
+            return self.found[('package', name)]  # type: ignore
+        self._packages.read_until(lambda: name in self.packages_by_name)
+        return self.packages_by_name.get(name)
+
+    def package_by_uuid(self, uuid: str) -> Optional[Package]:
+        self._packages.read_until(lambda: uuid in self.packages_by_uuid)
+        return self.packages_by_uuid.get(uuid)
+
+    def user(self, email: str) -> Optional[User]:
+        if email not in self.users_by_email and self.find(self._users, self.find_user, ('user', email), email):
+            return self.found[('user', email)]  # type: ignore
+        self._users.read_until(lambda: email in self.users_by_email)
+        return self.users_by_email.get(email)
+
+    def user_by_hash_id(self, hash_id: str) -> Optional[User]:
+        self._users.read_until(lambda: hash_id in self.users_by_hash_id)
+        return self.users_by_hash_id.get(hash_id)
+
+    def token(self, package: Package, user: User) -> Optional[Token]:
+        pair = (package.uuid, user.hash_id)
+        key = ('token',) + pair
+        if pair not in self.tokens_by_pair and self.find(self._tokens, self.find_token, key, package, user):
+            return self.found[key]  # type: ignore
+        self._tokens.read_until(lambda: pair in self.tokens_by_pair)
+        return self.tokens_by_pair.get(pair)
+
+    def tokens_for_package(self, package: Package) -> List[Token]:
+        self._tokens.read_all()
+        return list(self.tokens_by_package.get(package.uuid, []))
+
+    def tokens_for_user(self, user: User) -> List[Token]:
+        self._tokens.read_all()
+        return list(self.tokens_by_user.get(user.hash_id, []))
+
+    def invalidate_tokens(self) -> None:
+        """
+        Forgets the token listing, e.g. after creating or deleting a token, so that it is read again when needed
+        """
+        self._tokens = Listing(self._get_tokens, self.index_token)
+        self.found = {key: value for key, value in self.found.items() if key[0] != 'token'}
+        self.tokens_by_pair.clear()
+        self.tokens_by_package.clear()
+        self.tokens_by_user.clear()
+
+
+class Inventory(object):
+    """
+    Keeps the listings that commands have read in full, so that later commands run by the same process (i.e. by
+    `packagr agent`) can reuse them for up to `ttl` seconds instead of reading them again. Nothing is kept if `ttl` is
+    0, which is the default
+    """
+    def __init__(self, ttl: float = None) -> None:
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self._listings: Dict[Tuple[str, str], Tuple[float, List[Any]]] = {}
+
+    def get(self, kind: str, owner: str) -> Optional[List[Any]]:
+        entry = self._listings.get((kind, owner))
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+
+    def set(self, kind: str, owner: str, items: List[Any]) -> None:
+        if self.ttl > 0:
+            self._listings[(kind, owner)] = time.monotonic(), items
+
+    def invalidate(self, kind: str = None) -> None:
+        """
+        Forgets a kind of listing (e.g. `tokens`, after one has been created), or every listing
+        """
+        self._listings = {key: value for key, value in self._listings.items() if kind is not None and key[0] != kind}
+
+
+inventory = Inventory()
@@ -0,0 +1,144 @@
+import contextlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+
+def redact(text: str) -> str:
+    """
+    Hides the credentials in any urls in `text`, e.g. the authenticated index url passed to pip
+    """
+    return re.sub(r'://[^/@\s]+@', '://***@', text)
+
+
+class Timings(object):
+    """
+    Records how long each phase of a command took (HTTP requests, config reads and writes, build steps, subprocesses
+    and so on), for the `--timings` option. Nothing is recorded unless it has been enabled
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: List[Dict[str, Any]] = []
+        self.start = time.perf_counter()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.events = []
+        self.start = time.perf_counter()
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def add(self, phase: str, name: str, seconds: float, **details: Any) -> None:
+        if self.enabled:
+            self.events.append(dict(phase=phase, name=redact(name), seconds=seconds, **details))
+
+    @contextlib.contextmanager
+    def phase(self, phase: str, name: str, **details: Any) -> Iterator[Dict[str, Any]]:
+        """
+        Times the block as a phase. The dict yielded can be used to add details (e.g. a status code) to the record
+        """
+        start = time.perf_counter()
+        try:
+            yield details
+        finally:
+            self.add(phase, name, time.perf_counter() - start, **details)
+
+    def totals(self) -> Dict[str, Dict[str, float]]:
+        totals: Dict[str, Dict[str, float]] = OrderedDict()
+        for event in self.events:
+            total = totals.setdefault(event['phase'], {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += event['seconds']
+        return totals
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'total': time.perf_counter() - self.start,
+            'phases': self.totals(),
+            'events': self.events,
+        }
+
+    def report(self) -> Iterator[str]:
+        """
+        Yields the lines of a human readable report: each phase in the order it happened, then the totals per phase
+        """
+        for event in self.events:
+            details = [str(event[key]) for key in ['status', 'returncode', 'error'] if event.get(key) is not None]
+            if event.get('sent'):
+                details.append(f'sent {format_bytes(event["sent"])}')
+            if event.get('received') is not None:
+                details.append(f'received {format_bytes(event["received"])}')
+            if event.get('cached'):
+                details.append('(cached)')
+            yield f'{event["phase"]:<10} {event["seconds"] * 1000:>9.1f} ms  {event["name"]}  {" ".join(details)}'
+
+        yield ''
+        for phase, total in self.totals().items():
+            yield f'{phase:<10} {total["seconds"] * 1000:>9.1f} ms  ({int(total["count"])} calls)'
+        yield f'{"total":<10} {(time.perf_counter() - self.start) * 1000:>9.1f} ms'
+
+
+def format_bytes(size: int) -> str:
+    return f'{size} B' if size < 1024 else f'{size / 1024:.1f} KB'
+
+
+timings = Timings()
+
+
+@contextlib.contextmanager
+def profile(path: Optional[str]) -> Iterator[None]:
+    """
+    Runs the block under cProfile and tracemalloc, writing the profile to `path` (it can be read with `pstats` or a
+    viewer such as snakeviz) and the places that allocated the most memory to `path` + `.memory.txt`
+    """
+    if not path:
+        yield
+        return
+
+    import cProfile
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(path)
+        with open(f'{path}.memory.txt', 'w') as f:
+            f.write(f'Peak memory: {peak / 1024:.1f} KB, at exit: {current / 1024:.1f} KB\n\n')
+            for statistic in snapshot.statistics('lineno')[:25]:
+                f.write(f'{statistic}\n')
+
+
+@contextlib.contextmanager
+def record(io, show: bool, path: Optional[str]) -> Iterator[None]:
+    """
+    Records the timings of the block if they were asked for, then prints them (to stderr) and/or writes them to a
+    JSON file
+    """
+    if not show and not path:
+        yield
+        return
+
+    timings.enable()
+    try:
+        yield
+    finally:
+        timings.disable()
+
+        if path:
+            with open(path, 'w') as f:
+                f.write(json.dumps(timings.as_dict(), indent=2))
+
+        if show:
+            for line in timings.report():
+                io.error_line(line)
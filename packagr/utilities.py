@@ -1,102 +1,266 @@
-import toml
-from typing import Any, MutableMapping, Optional, List, Tuple
+import fnmatch
+import hashlib
+import re
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, Mapping, MutableMapping, Optional, List, Set, Tuple
+from urllib.parse import urlencode
+from packagr.cache import CapabilityCache, ResponseCache, TokenCache, identity
+from packagr.client import get_client
+from packagr.config import store
+from packagr.multipart import MultipartEncoder
 from packagr.objects import Package, Token, User
-import requests
 import os
 
+if TYPE_CHECKING:
+    import requests
+
+LOGIN_PATH = 'api/auth/login/'
+
 
 def get_package_config(path: str = 'packagr.toml') -> MutableMapping:
     """
     Returns the content of the package config file as a dict
     """
-    with open(path, 'r') as f:
-        config: MutableMapping[str, Any] = toml.loads(f.read())
-        return config
+    return store.load(path)
 
 
-def write_package_content(config: dict, path: str = 'packagr.toml') -> None:
+def write_package_content(config: MutableMapping[str, Any],
+                          path: str = 'packagr.toml',
+                          base: MutableMapping[str, Any] = None) -> None:
     """
-    Writes a given dict to the package config file
+    Writes a given dict to the package config file. If `base` is given, changes made to the file by other processes
+    since it was read are kept (see `ConfigStore.save`)
     """
-    with open(path, 'w') as f:
-        f.write(toml.dumps(config))
+    store.save(path, config, base=base)
 
 
-def check_configuration(hash_id: str, email: str, password: str) -> bool:
+def login(email: str, password: str) -> 'requests.Response':
     post = {
         'email'   : email,
         'password': password
     }
-    response = requests.post('https://api.packagr.app/api/auth/login/', post)
-    assert response.status_code == 200
-    assert response.json().get('profile', {}).get('hash_id') == hash_id
-    return True
+    # logging in has no side effects, so it can be retried like a GET
+    return get_client().request('post', LOGIN_PATH, data=post, retry=True)
 
 
-def get_access_token(path: str = None):
-    if not path:
-        path = os.path.expanduser('~/packagr_conf.toml')
-    config = get_package_config(path=path)
-
-    if check_configuration(config['hash-id'], config['email'], config['password']):
-        post = {
-            'email': config['email'],
-            'password': config['password']
-        }
-        response = requests.post('https://api.packagr.app/api/auth/login/', post)
+def check_configuration(hash_id: str, email: str, password: str, refresh: bool = False) -> bool:
+    """
+    Checks that the credentials are for the account. This is done by getting a login token for it, so a token that is
+    already cached is used without logging in again, and the one fetched is kept for the rest of the command
+    """
+    config = {'hash-id': hash_id, 'email': email, 'password': password}
+    assert get_access_token(refresh=refresh, config=config)
+    return True
 
-        try:
-            assert response.status_code == 200
-            token = response.json()['token']
-            return token
 
-        except AssertionError:
+def get_access_token(path: str = None,
+                     refresh: bool = False,
+                     config: Mapping[str, Any] = None) -> Optional[str]:
+    """
+    Returns a login token for the configured account (or the one in `config`), reusing a cached one until it expires.
+    A single login request is made when no valid token is cached (or when `refresh` is set)
+    """
+    if config is None:
+        config = get_package_config(path=path or os.path.expanduser('~/packagr_conf.toml'))
+        if not config:
             return None
 
+    cache = TokenCache()
+    account = f'{config["hash-id"]}:{config["email"]}'
+    endpoint = get_client().url(LOGIN_PATH)
+
+    if not refresh:
+        token = cache.get(account, endpoint)
+        if token:
+            return token
 
-def get_packages(headers: dict) -> Optional[List[Package]]:
-    response = requests.get('https://api.packagr.app/api/v1/packages/', headers=headers)
+    response = login(config['email'], config['password'])
 
     try:
         assert response.status_code == 200
-    except AssertionError:
+        content = response.json()
+        assert content.get('profile', {}).get('hash_id') == config['hash-id']
+        token = content['token']
+    except (AssertionError, KeyError):
         return None
 
-    packages = []
-    for pkg in response.json():
-        packages.append(Package(**pkg))
+    cache.set(account, endpoint, token)
+    return token
 
-    return packages
 
+def send(method: str, path: str, headers: dict = None, extra_headers: dict = None, **kwargs) -> 'requests.Response':
+    """
+    Sends an API request through the shared client. If the request was authenticated with a login token and is
+    rejected with a 401, the token is refreshed once and the request is retried. The new token is written back into
+    `headers`. `extra_headers` are sent with this request only
+    """
+    client = get_client()
+    response = client.request(method, path, headers=dict(headers or {}, **(extra_headers or {})), **kwargs)
+
+    if response.status_code == 401 and headers and headers.get('Authorization', '').startswith('JWT '):
+        token = get_access_token(refresh=True)
+        if token:
+            headers['Authorization'] = f'JWT {token}'
+            response = client.request(method, path, headers=dict(headers, **(extra_headers or {})), **kwargs)
+
+    return response
+
+
+def cached_get(path: str, headers: dict, use_cache: bool = True) -> 'requests.Response':
+    """
+    Sends a GET request, reusing the cached response body if the server says it has not changed (or if the cached
+    copy is still within its TTL)
+    """
+    if not use_cache:
+        return send('get', path, headers=headers)
+
+    cache = ResponseCache()
+    url = get_client().url(path)
+    owner = identity(headers)
+    entry = cache.get(url, owner)
 
-def get_tokens(headers: dict) -> Optional[List[Token]]:
-    response = requests.get('https://api.packagr.app/api/v1/tokens/', headers=headers)
+    conditional = {}
+    if entry:
+        if cache.is_fresh(entry):
+            return cached_response(entry)
+        if entry.get('etag'):
+            conditional['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            conditional['If-Modified-Since'] = entry['last_modified']
 
+    response = send('get', path, headers=headers, extra_headers=conditional)
+
+    if response.status_code == 304 and entry:
+        cache.revalidated(url, owner, entry)
+        return cached_response(entry)
+
+    if response.status_code == 200:
+        cache.set(url, owner, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+    return response
+
+
+def cached_response(entry: dict) -> 'requests.Response':
+    import requests
+
+    response = requests.Response()
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response._content = entry['content'].encode('utf-8')
+    return response
+
+
+def invalidate_cache(path: str, headers: dict) -> None:
+    """
+    Drops the cached response for a path, e.g. after changing the collection it lists
+    """
+    ResponseCache().invalidate(get_client().url(path), identity(headers))
+
+
+def iter_pages(path: str, headers: dict, use_cache: bool = True) -> Iterator[dict]:
+    """
+    Yields the items of an API listing. Paginated listings are followed page by page (via the `next` url of each
+    page), and a page is only requested once the items of the previous one have been used, so callers that stop early
+    don't fetch the rest. Raises AssertionError if a page cannot be fetched
+    """
+    next_page: Optional[str] = path
+
+    while next_page:
+        response = cached_get(next_page, headers, use_cache=use_cache)
+        assert response.status_code == 200, f'Unexpected status code {response.status_code}'
+
+        content = response.json()
+        if isinstance(content, list):
+            # the listing isn't paginated
+            yield from content
+            return
+
+        yield from content.get('results', [])
+        next_page = content.get('next')
+
+
+def iter_packages(headers: dict, use_cache: bool = True) -> Iterator[Package]:
+    for pkg in iter_pages('api/v1/packages/', headers, use_cache=use_cache):
+        yield Package(**pkg)
+
+
+def iter_tokens(headers: dict, use_cache: bool = True) -> Iterator[Token]:
+    for token in iter_pages('api/v1/tokens/', headers, use_cache=use_cache):
+        yield Token(**token)
+
+
+def iter_users(headers: dict, use_cache: bool = True) -> Iterator[User]:
+    for usr in iter_pages('api/v1/subusers/', headers, use_cache=use_cache):
+        yield User(**usr)
+
+
+def get_packages(headers: dict, use_cache: bool = True) -> Optional[List[Package]]:
     try:
-        assert response.status_code == 200
+        return list(iter_packages(headers, use_cache=use_cache))
     except AssertionError:
         return None
 
-    tokens = []
-    for token in response.json():
-        tokens.append(Token(**token))
-
-    return tokens
 
+def get_tokens(headers: dict, use_cache: bool = True) -> Optional[List[Token]]:
+    try:
+        return list(iter_tokens(headers, use_cache=use_cache))
+    except AssertionError:
+        return None
 
-def get_users(headers: dict) -> Optional[List[User]]:
-    response = requests.get('https://api.packagr.app/api/v1/subusers/', headers=headers)
 
+def get_users(headers: dict, use_cache: bool = True) -> Optional[List[User]]:
     try:
-        assert response.status_code == 200
+        return list(iter_users(headers, use_cache=use_cache))
     except AssertionError:
         return None
 
-    users = []
-    for usr in response.json():
-        users.append(User(**usr))
 
-    return users
+def find(path: str, filters: Dict[str, str], headers: dict, matches: Callable[[dict], bool]) -> Optional[List[dict]]:
+    """
+    Returns the items of a listing that match `filters`, letting the server do the filtering. Returns None if the
+    server doesn't support filtering this listing, in which case the caller should look through the whole listing
+    instead. Whether it does is found out from the first filtered request (a server that ignores the filters returns
+    items that don't match) and remembered for the account. Responses aren't cached, as they are small and would
+    otherwise need invalidating along with the full listing
+    """
+    capabilities = CapabilityCache()
+    owner = identity(headers)
+    endpoint = get_client().url(path)
+
+    if capabilities.get(owner, endpoint) is False:
+        return None
+
+    found = []
+    for item in iter_pages(f'{path}?{urlencode(filters)}', headers, use_cache=False):
+        if not matches(item):
+            capabilities.set(owner, endpoint, False)
+            return None
+        found.append(item)
+
+    # an empty result doesn't tell us anything: the account may simply have nothing that matches
+    if found:
+        capabilities.set(owner, endpoint, True)
+
+    return found
+
+
+def find_package(headers: dict, name: str) -> Optional[List[Package]]:
+    found = find('api/v1/packages/', {'name': name}, headers, lambda item: item.get('name') == name)
+    return None if found is None else [Package(**pkg) for pkg in found]
+
+
+def find_user(headers: dict, email: str) -> Optional[List[User]]:
+    found = find('api/v1/subusers/', {'email': email}, headers, lambda item: item.get('email') == email)
+    return None if found is None else [User(**usr) for usr in found]
+
+
+def find_token(headers: dict, package: Package, user: User) -> Optional[List[Token]]:
+    found = find(
+        'api/v1/tokens/',
+        {'package': package.uuid, 'user': user.hash_id},
+        headers,
+        lambda item: item.get('package') == package.uuid and item.get('user') == user.hash_id
+    )
+    return None if found is None else [Token(**token) for token in found]
 
 
 def create_access_token(
@@ -112,10 +276,11 @@ def create_access_token(
         'package': package.uuid,
         'write_access': write_access
     }
-    response = requests.post('https://api.packagr.app/api/v1/tokens/',  post, headers=headers)
+    response = send('post', 'api/v1/tokens/', data=post, headers=headers)
 
     try:
         assert response.status_code == 201
+        invalidate_cache('api/v1/tokens/', headers)
         return True, None
     except AssertionError:
         return False, response.status_code
@@ -133,12 +298,221 @@ def delete_access_token(token: Token, headers: dict, path: str = None) -> Tuple[
         except AssertionError:
             return False, 'Cannot delete access tokens belonging to the account owner'
 
-        response = requests.delete(f'https://api.packagr.app/api/v1/tokens/{token.uuid}/', headers=headers)
+        response = send('delete', f'api/v1/tokens/{token.uuid}/', headers=headers)
 
         try:
             assert response.status_code == 204
+            invalidate_cache('api/v1/tokens/', headers)
             return True, None
         except AssertionError:
             return False, f'Could not delete access token due to {response.status_code} error'
 
     return False, 'Package config not found'
+
+
+SDIST_EXTENSIONS = ['.tar.gz', '.tar.bz2', '.tar.xz', '.tgz', '.zip']
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalizes a project name as per PEP 503, e.g. My_Package > my-package
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def normalize_version(version: str) -> str:
+    """
+    Normalizes a version the way setuptools does in the names of the files it builds (see PEP 440), e.g.
+    1.0-beta > 1.0b0. Versions that aren't valid PEP 440 versions only have their separators made consistent
+    """
+    try:
+        from packaging.version import InvalidVersion, Version
+    except ImportError:  # pragma: no cover - setuptools and pip both depend on it
+        return re.sub(r'[^A-Za-z0-9.]+', '_', version).lower()
+
+    try:
+        return str(Version(version))
+    except InvalidVersion:
+        return re.sub(r'[^A-Za-z0-9.]+', '_', version).lower()
+
+
+def parse_artifact_filename(filename: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the (normalized) project name and version of a wheel or sdist filename, or None if the file is neither
+    """
+    if filename.endswith('.whl'):
+        parts = filename[:-len('.whl')].split('-')
+        if len(parts) not in (5, 6):
+            return None
+        return normalize_name(parts[0]), parts[1]
+
+    for extension in SDIST_EXTENSIONS:
+        if filename.endswith(extension):
+            name, _, version = filename[:-len(extension)].rpartition('-')
+            if not name or not version:
+                return None
+            return normalize_name(name), version
+
+    return None
+
+
+def select_artifacts(name: str,
+                     version: str,
+                     directory: str = 'dist',
+                     all_files: bool = False,
+                     patterns: List[str] = None) -> List[str]:
+    """
+    Returns the paths of the built packages in `directory` (not including subdirectories) for the given name and
+    version. If `all_files` is set, every file is returned regardless of name and version. If `patterns` are given,
+    only files matching at least one of them are returned
+    """
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return []
+
+    # setuptools normalizes the version in the filenames, so e.g. `1.0-beta` is built as `1.0b0`
+    version = normalize_version(version)
+    paths = []
+
+    for entry in sorted(entries, key=lambda x: x.name):
+        if not entry.is_file():
+            continue
+        if patterns and not any(fnmatch.fnmatch(entry.name, pattern) for pattern in patterns):
+            continue
+        if not all_files:
+            parsed = parse_artifact_filename(entry.name)
+            if not parsed or parsed[0] != normalize_name(name) or normalize_version(parsed[1]) != version:
+                continue
+        paths.append(entry.path)
+
+    return paths
+
+
+def file_digest(path: str, algorithm: str = 'sha256') -> str:
+    """
+    Returns the hex digest of a file's content, reading it in chunks
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def package_path(package: str, package_dir: Mapping[str, str]) -> str:
+    """
+    Returns the folder a package (e.g. `my_package.sub`) is in, following setuptools' `package_dir` mapping, e.g.
+    `{"" = "src"}`
+    """
+    parts = package.split('.') if package else []
+
+    for i in range(len(parts), -1, -1):
+        prefix = '.'.join(parts[:i])
+        if prefix in package_dir:
+            return os.path.join(package_dir[prefix], *parts[i:]) if parts[i:] or package_dir[prefix] else '.'
+
+    return os.path.join(*parts) if parts else '.'
+
+
+def source_files(config: MutableMapping[str, Any], path: str = 'packagr.toml') -> Optional[List[str]]:
+    """
+    Returns the files that a build of the package depends on: the config file, the package source trees, modules,
+    scripts and data files. Returns None if the folder of a package cannot be found, as the build cannot be judged
+    to be up to date then
+    """
+    files = [path]
+    package_dir = config.get('package_dir', {})
+
+    for package in config.get('packages', []):
+        directory = package_path(package, package_dir)
+        if not os.path.isdir(directory):
+            return None
+
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = sorted(name for name in dirs if name != '__pycache__')
+            files.extend(os.path.join(root, name) for name in sorted(names) if not name.endswith(('.pyc', '.pyo')))
+
+    for module in config.get('py_modules', []):
+        package, _, name = module.rpartition('.')
+        files.append(os.path.join(package_path(package, package_dir), name + '.py'))
+    files.extend(config.get('scripts', []))
+
+    for entry in config.get('data_files', []):
+        # either a file name, or a (directory, [file names]) pair
+        if isinstance(entry, str):
+            files.append(entry)
+        else:
+            files.extend(entry[1])
+
+    return list(dict.fromkeys(files))
+
+
+def source_fingerprint(config: MutableMapping[str, Any], path: str = 'packagr.toml') -> Optional[str]:
+    """
+    Returns a digest of the names and content of all the files a build depends on, or None if they cannot all be
+    found
+    """
+    files = source_files(config, path)
+    if files is None:
+        return None
+
+    digest = hashlib.sha256()
+
+    for file in files:
+        digest.update(file.encode() + b'\0')
+        digest.update(file_digest(file).encode() if os.path.isfile(file) else b'missing')
+
+    return digest.hexdigest()
+
+
+def get_existing_files(headers: dict, name: str, version: str, digests: Dict[str, str]) -> Optional[Set[str]]:
+    """
+    Asks Packagr which of the given files (a dict of filename to sha256 digest) it already has for a package version.
+    Returns the names of the files whose content matches, or None if the server cannot tell us
+    """
+    post = {
+        'files': [
+            {'name': name, 'version': version, 'filename': filename, 'sha256_digest': digest}
+            for filename, digest in digests.items()
+        ]
+    }
+    response = send('post', 'api/v1/files/lookup/', json=post, headers=headers, retry=True)
+
+    try:
+        assert response.status_code == 200
+        return {
+            file['filename'] for file in response.json()
+            if digests.get(file.get('filename')) == file.get('sha256_digest')
+        }
+    except (AssertionError, ValueError, TypeError, AttributeError):
+        return None
+
+
+def upload_file(hash_id: str, auth: Tuple[str, str], data: dict, path: str) -> 'requests.Response':
+    """
+    Uploads a built package file to the account's repository. The file is streamed from disk rather than read into
+    memory, and is sent again from the start if the upload fails in a way that can be retried
+    """
+    with MultipartEncoder(data, 'content', path) as body:
+        return get_client().request(
+            'post',
+            f'{hash_id}/',
+            auth=auth,
+            data=body,
+            retry=True,
+            headers={'Content-Type': body.content_type}
+        )
+
+
+def format_size(size: float) -> str:
+    """
+    Formats a number of bytes for display, e.g. 1536 > 1.5 KB
+    """
+    if size < 1024:
+        return f'{int(size)} B'
+    for unit in ['KB', 'MB']:
+        size /= 1024
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+    return f'{size / 1024:.1f} GB'
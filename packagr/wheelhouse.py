@@ -0,0 +1,272 @@
+"""
+A local cache of the wheels installed from Packagr, so that installing the same version again (e.g. in every CI job)
+doesn't download it again. Wheels are stored by the sha256 digest of their content, as `<digest>/<filename>`, and the
+filename says which project, version and tags the wheel is for. The least recently used wheels are removed once the
+wheelhouse grows beyond its maximum size
+
+pip is given the wheels as direct references (`name @ file:///...`) rather than with `--find-links`, as it prefers the
+index's copy of a file to an identical local one
+"""
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import sys
+import tempfile
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+from packagr.artifacts import verify
+from packagr.cache import CACHE_DIR, WHEELHOUSE_SIZE
+from packagr.client import get_client
+from packagr.utilities import normalize_name, parse_artifact_filename
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def supported_tags() -> List[str]:
+    """
+    Returns the tags (e.g. `cp38-cp38-manylinux1_x86_64`) of the wheels that can be installed on this interpreter,
+    most specific first
+    """
+    try:
+        from packaging.tags import sys_tags
+        return [str(tag) for tag in sys_tags()]
+    except ImportError:
+        pass
+
+    try:
+        from wheel.pep425tags import get_supported
+        return ['-'.join(tag) for tag in get_supported()]
+    except ImportError:
+        # pure Python wheels, which is what most private packages are
+        major, minor = sys.version_info[:2]
+        return [f'py{major}{minor}-none-any', f'py{major}-none-any']
+
+
+def wheel_tags(filename: str) -> Set[str]:
+    """
+    Returns the tags of a wheel, expanding compressed tag sets (e.g. `py2.py3-none-any`)
+    """
+    python, abi, platform = filename[:-len('.whl')].split('-')[-3:]
+    return {f'{p}-{a}-{x}' for p in python.split('.') for a in abi.split('.') for x in platform.split('.')}
+
+
+def parse_requirement(requirement: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the normalized project name and version of a requirement pinned to a version with `==`, e.g.
+    `my-package[extra]==1.0.0`. Returns None for any other kind of requirement, which is left to pip
+    """
+    match = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*==\s*([A-Za-z0-9.+!_-]+)\s*$', requirement)
+    if not match:
+        return None
+    return normalize_name(match.group(1)), match.group(3)
+
+
+def direct_reference(requirement: str, path: str) -> str:
+    """
+    Returns a requirement for the wheel at `path`, e.g. `my-package[extra] @ file:///.../my_package-1.0.0-...whl`
+    """
+    return f'{requirement.split("==")[0].strip()} @ {pathlib.Path(path).resolve().as_uri()}'
+
+
+class IndexPage(HTMLParser):
+    """
+    Reads the links of a project page of a simple (PEP 503) package index, as `(filename, url, sha256)`. The digest
+    is None if the link doesn't include it. Yanked files are left out
+    """
+    def __init__(self, url: str) -> None:
+        super().__init__()
+        self.url = url
+        self.links: List[Tuple[str, str, Optional[str]]] = []
+        self.attributes: Optional[Dict[str, Optional[str]]] = None
+        self.text = ''
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag == 'a':
+            self.attributes = dict(attrs)
+            self.text = ''
+
+    def handle_data(self, data: str) -> None:
+        if self.attributes is not None:
+            self.text += data
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag != 'a' or self.attributes is None:
+            return
+
+        attributes, self.attributes = self.attributes, None
+        if not attributes.get('href') or 'data-yanked' in attributes:
+            return
+
+        url, fragment = urldefrag(urljoin(self.url, attributes['href']))
+        filename = self.text.strip() or os.path.basename(urlsplit(url).path)
+        digest = fragment[len('sha256='):] if fragment.startswith('sha256=') else None
+        self.links.append((filename, url, digest))
+
+
+class Wheelhouse(object):
+    """
+    The wheels downloaded from Packagr, keyed by the digest of their content
+    """
+    def __init__(self, root: str = None, max_size: int = None, tags: List[str] = None) -> None:
+        self.root = root or os.path.join(CACHE_DIR, 'wheels')
+        self.max_size = WHEELHOUSE_SIZE if max_size is None else max_size
+        self.tags = supported_tags() if tags is None else tags
+
+    def path(self, digest: str, filename: str) -> str:
+        return os.path.join(self.root, digest, filename)
+
+    def wheels(self) -> List[Tuple[str, str]]:
+        """
+        Returns the `(digest, filename)` of every wheel in the wheelhouse
+        """
+        try:
+            directories = [entry for entry in os.scandir(self.root) if entry.is_dir()]
+        except OSError:
+            return []
+
+        wheels: List[Tuple[str, str]] = []
+        for directory in directories:
+            try:
+                wheels.extend((directory.name, name) for name in os.listdir(directory.path) if name.endswith('.whl'))
+            except OSError:
+                pass
+        return wheels
+
+    def rank(self, filename: str) -> Optional[int]:
+        """
+        Returns how well a wheel suits this interpreter (lower is better), or None if it can't be installed at all
+        """
+        ranks = [self.tags.index(tag) for tag in wheel_tags(filename) if tag in self.tags]
+        return min(ranks) if ranks else None
+
+    def best(self, filenames: List[str], name: str, version: str) -> Optional[str]:
+        """
+        Returns the wheel of a version of a project that suits this interpreter best, if any of them do
+        """
+        candidates: Dict[str, int] = {}
+        for filename in filenames:
+            rank = self.rank(filename) if filename.endswith('.whl') else None
+            if rank is not None and parse_artifact_filename(filename) == (name, version):
+                candidates[filename] = rank
+        return min(candidates, key=candidates.__getitem__) if candidates else None
+
+    def find(self, name: str, version: str) -> Optional[str]:
+        """
+        Returns the path of a wheel of a version of a project, if the wheelhouse has one for this interpreter
+        """
+        wheels = dict((filename, digest) for digest, filename in self.wheels())
+        filename = self.best(list(wheels), name, version)
+        return self.use(self.path(wheels[filename], filename)) if filename else None
+
+    def get(self, digest: str, filename: str) -> Optional[str]:
+        path = self.path(digest, filename)
+        return self.use(path) if os.path.exists(path) else None
+
+    @staticmethod
+    def use(path: str) -> str:
+        """
+        Marks a wheel as recently used, so that it is the last to be evicted
+        """
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def download(self, url: str, filename: str, digest: Optional[str], auth: Optional[Tuple[str, str]]) -> str:
+        """
+        Downloads a wheel into the wheelhouse, checking that it is complete and matches its digest on the index.
+        Returns its path
+        """
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp-', suffix='.whl')
+
+        try:
+            sha256 = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                response = get_client().request('get', url, auth=auth, stream=True)
+                with response:
+                    if response.status_code != 200:
+                        raise ValueError(f'status code {response.status_code}')
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        sha256.update(chunk)
+                        f.write(chunk)
+
+            actual = sha256.hexdigest()
+            if digest and actual != digest:
+                raise ValueError('the download does not match its sha256 digest on the index')
+
+            error = verify(tmp_path).error
+            if error:
+                raise ValueError(f'the download is corrupt: {error}')
+
+            path = self.path(actual, filename)
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            os.replace(tmp_path, path)
+            return path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def prefetch(self, index_url: str, auth: Tuple[str, str], requirement: str) -> Tuple[Optional[str], str]:
+        """
+        Makes sure the wheelhouse has the wheel of a pinned requirement, if it is on Packagr. Returns the path of the
+        wheel and whether it was `cached` or `downloaded`, or no path if there is nothing to fetch. A wheel that is
+        already in the wheelhouse is found without asking Packagr at all
+        """
+        parsed = parse_requirement(requirement)
+        if not parsed:
+            return None, 'skipped'
+        name, version = parsed
+
+        path = self.find(name, version)
+        if path:
+            return path, 'cached'
+
+        response = get_client().request('get', urljoin(index_url, f'{name}/'), auth=auth)
+        if response.status_code == 404:
+            # not a Packagr package, so pip gets it from PyPI
+            return None, 'skipped'
+        if response.status_code != 200:
+            raise ValueError(f'status code {response.status_code}')
+
+        page = IndexPage(response.url)
+        page.feed(response.text)
+        links = {filename: (url, digest) for filename, url, digest in page.links}
+
+        filename = self.best(list(links), name, version)
+        if not filename:
+            return None, 'skipped'
+
+        url, digest = links[filename]
+        path = self.get(digest, filename) if digest else None
+        if path:
+            return path, 'cached'
+
+        # the credentials are only for Packagr, not for wherever else the files may be hosted
+        same_host = urlsplit(url).netloc == urlsplit(index_url).netloc
+        return self.download(url, filename, digest, auth if same_host else None), 'downloaded'
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used wheels until the wheelhouse fits within `max_size`
+        """
+        wheels = []
+        for digest, filename in self.wheels():
+            path = self.path(digest, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            wheels.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in wheels)
+        for _, size, path in sorted(wheels):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            total -= size
@@ -0,0 +1,115 @@
+import os
+import re
+from typing import Any, Dict, Iterable, List, MutableMapping, Optional, Set
+from packagr.config import store
+from packagr.utilities import normalize_name
+
+# folders that never contain packages of the workspace
+SKIPPED_DIRS = {'build', 'dist', 'node_modules', '__pycache__', 'site-packages'}
+
+
+def requirement_name(requirement: str) -> Optional[str]:
+    """
+    Returns the normalized name of the project a requirement (e.g. `requests[socks]>=2.0; python_version > "3.6"`)
+    refers to
+    """
+    match = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)', requirement)
+    return normalize_name(match.group(1)) if match else None
+
+
+class Member(object):
+    """
+    A package of the workspace: a folder with a `packagr.toml`
+    """
+    def __init__(self, path: str, config: MutableMapping[str, Any]) -> None:
+        self.path = path
+        self.config = config
+        self.name = normalize_name(str(config.get('name', os.path.basename(path))))
+        self.version = str(config.get('version', ''))
+        self.requires = {
+            name for name in (requirement_name(str(requirement)) for requirement in config.get('install_requires', []))
+            if name
+        }
+
+    def __repr__(self) -> str:
+        return f'<Member {self.name} {self.path}>'
+
+
+def discover(root: str) -> List[Member]:
+    """
+    Returns the packages found under `root`, in the order of their paths. Hidden folders, virtualenvs and build output
+    are skipped
+    """
+    members = []
+
+    for path, dirs, names in os.walk(root):
+        dirs[:] = sorted(
+            name for name in dirs
+            if not name.startswith('.') and name not in SKIPPED_DIRS
+            and not os.path.exists(os.path.join(path, name, 'pyvenv.cfg'))
+        )
+
+        if 'packagr.toml' in names:
+            members.append(Member(path, store.load(os.path.join(path, 'packagr.toml'))))
+
+    return members
+
+
+class Workspace(object):
+    """
+    The packages of a monorepo, and their dependencies on each other (through `install_requires`). Dependencies on
+    anything outside the workspace are ignored
+    """
+    def __init__(self, members: Iterable[Member]) -> None:
+        self.members: Dict[str, Member] = {}
+
+        for member in members:
+            if member.name in self.members:
+                raise ValueError(f'{member.name} is defined in both {self.members[member.name].path} and {member.path}')
+            self.members[member.name] = member
+
+        self.requires: Dict[str, Set[str]] = {
+            name: {dependency for dependency in member.requires if dependency in self.members and dependency != name}
+            for name, member in self.members.items()
+        }
+
+    def order(self) -> List[str]:
+        """
+        Returns the names of the packages, each one after the packages it depends on. Raises ValueError if some of them
+        depend on each other
+        """
+        order: List[str] = []
+        remaining = dict(self.requires)
+
+        while remaining:
+            ready = sorted(name for name, requires in remaining.items() if not requires - set(order))
+            if not ready:
+                raise ValueError(f'These packages depend on each other: {", ".join(sorted(remaining))}')
+
+            order.extend(ready)
+            for name in ready:
+                del remaining[name]
+
+        return order
+
+    def ready(self, done: Set[str], started: Set[str]) -> List[str]:
+        """
+        Returns the packages that haven't been started yet whose dependencies are all done
+        """
+        return sorted(name for name, requires in self.requires.items() if name not in started and requires <= done)
+
+    def dependents(self, name: str) -> Set[str]:
+        """
+        Returns the packages that depend on a package, directly or through others
+        """
+        found: Set[str] = set()
+        queue = [name]
+
+        while queue:
+            current = queue.pop()
+            for other, requires in self.requires.items():
+                if current in requires and other not in found:
+                    found.add(other)
+                    queue.append(other)
+
+        return found
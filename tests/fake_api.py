@@ -0,0 +1,335 @@
+import base64
+import hashlib
+import json
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+
+def make_jwt(claims: dict) -> str:
+    """
+    Returns an (unsigned) JWT with the given claims, which is all the CLI looks at
+    """
+    def encode(value: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+    return f'{encode({"alg": "none", "typ": "JWT"})}.{encode(claims)}.'
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    api: 'FakePackagrAPI'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def respond(self, status: int, content=None, headers: Dict[str, str] = None) -> None:
+        if isinstance(content, bytes):
+            body = content
+        else:
+            body = b'' if content is None else json.dumps(content).encode()
+        self.api.record(self.command, self.path, status)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if content is not None and not isinstance(content, bytes):
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, 1024 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def handle_request(self) -> None:
+        body = self.read_body()
+        if self.api.latency:
+            time.sleep(self.api.latency)
+        status, content, headers = self.api.dispatch(self.command, self.path, self.headers, body)
+        self.respond(status, content, headers)
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+
+class FakePackagrAPI(object):
+    """
+    A local, in-process stand-in for the Packagr API, serving an account with a generated inventory of packages, users
+    and access tokens. Every request is delayed by `latency` seconds to simulate a remote server, and recorded in
+    `requests` so that the number of requests a command makes can be checked. If `page_size` is set, listings are
+    paginated the way the real API paginates them. Listings can be filtered by field (e.g. `?name=`) unless `filters`
+    is False, in which case filters are ignored, like an older version of the API
+    """
+    def __init__(self,
+                 packages: int = 10,
+                 users: int = 10,
+                 tokens: int = 10,
+                 latency: float = 0.0,
+                 page_size: int = None,
+                 filters: bool = True,
+                 hash_id: str = '1234',
+                 email: str = 'owner@example.com',
+                 password: str = 'password') -> None:
+        self.latency = latency
+        self.page_size = page_size
+        self.filters = filters
+        self.hash_id = hash_id
+        self.email = email
+        self.password = password
+
+        self.packages = [{'name': self.package_name(i), 'uuid': f'p{i:08d}'} for i in range(packages)]
+        self.users = [{'email': self.user_email(i), 'hash_id': f'u{i:08d}'} for i in range(users)]
+        self.tokens = [dict(self.pair(i), uuid=f't{i:08d}', write_access=False) for i in range(tokens)]
+        self.next_token = tokens
+        self.uploads: List[Tuple[str, int]] = []
+        # the content of the uploaded files, served by the package index
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[Tuple[str, str, int]] = []
+        self.versions = {'packages': 0, 'subusers': 0, 'tokens': 0}
+        self.issued: set = set()
+        self.failures: Dict[str, List[Tuple[int, Optional[str]]]] = {}
+
+        self.lock = threading.Lock()
+        self.server: Optional[_Server] = None
+        self.thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def package_name(i: int) -> str:
+        return f'package-{i}'
+
+    @staticmethod
+    def user_email(i: int) -> str:
+        return f'user-{i}@example.com'
+
+    def pair(self, i: int) -> dict:
+        """
+        The package and user of the i-th access token. Tokens are spread over every package before a user gets a
+        second one, so pairs past the end of the token list have no token yet
+        """
+        return {
+            'package': self.packages[i % len(self.packages)]['uuid'],
+            'user': self.users[(i // len(self.packages)) % len(self.users)]['hash_id'],
+        }
+
+    def pair_names(self, i: int) -> Tuple[str, str]:
+        return self.package_name(i % len(self.packages)), self.user_email((i // len(self.packages)) % len(self.users))
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'FakePackagrAPI':
+        self.server = _Server(('127.0.0.1', 0), type('Handler', (_Handler,), {'api': self}))
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self) -> 'FakePackagrAPI':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def record(self, method: str, path: str, status: int) -> None:
+        with self.lock:
+            self.requests.append((method, path, status))
+
+    def fail(self, path: str, *statuses: int, retry_after: str = None) -> None:
+        """
+        Makes the next requests to `path` fail with the given statuses, in order, before it works again
+        """
+        with self.lock:
+            self.failures.setdefault(path, []).extend((status, retry_after) for status in statuses)
+
+    def reset(self) -> None:
+        """
+        Forgets the requests made so far
+        """
+        with self.lock:
+            self.requests = []
+
+    def dispatch(self, method: str, path: str, headers, body: bytes) -> Tuple[int, object, Dict[str, str]]:
+        path, query = urlsplit(path).path, parse_qs(urlsplit(path).query)
+
+        with self.lock:
+            if self.failures.get(path):
+                status, retry_after = self.failures[path].pop(0)
+                return status, {'detail': 'Try again later'}, {'Retry-After': retry_after} if retry_after else {}
+
+        if method == 'POST' and path == '/api/auth/login/':
+            return self.login(parse_qs(body.decode()))
+
+        if path == f'/{self.hash_id}/' and method == 'POST':
+            return self.upload(headers, body)
+
+        if path.startswith(f'/{self.hash_id}/') and method == 'GET':
+            return self.index(headers, path[len(f'/{self.hash_id}/'):].strip('/'))
+
+        if path.startswith('/files/') and method == 'GET':
+            return self.download(headers, path[len('/files/'):])
+
+        if not path.startswith('/api/v1/'):
+            return 404, None, {}
+
+        if headers.get('Authorization', '')[4:] not in self.issued:
+            return 401, {'detail': 'Invalid token'}, {}
+
+        with self.lock:
+            return self.api(method, path[len('/api/v1/'):].strip('/').split('/'), headers, body, query)
+
+    def login(self, form: Dict[str, List[str]]) -> Tuple[int, object, Dict[str, str]]:
+        if form.get('email') != [self.email] or form.get('password') != [self.password]:
+            return 400, {'non_field_errors': ['Unable to log in with provided credentials.']}, {}
+
+        now = int(time.time())
+        token = make_jwt({'user_id': self.hash_id, 'email': self.email, 'exp': now + 3600, 'orig_iat': now})
+        with self.lock:
+            self.issued.add(token)
+        return 200, {'token': token, 'profile': {'hash_id': self.hash_id}}, {}
+
+    def authorized(self, headers) -> bool:
+        credentials = base64.b64encode(f'{self.email}:{self.password}'.encode()).decode()
+        return headers.get('Authorization') == f'Basic {credentials}'
+
+    def upload(self, headers, body: bytes) -> Tuple[int, object, Dict[str, str]]:
+        if not self.authorized(headers):
+            return 401, {'detail': 'Invalid credentials'}, {}
+
+        # like Packagr, rejects a file that doesn't match the digest sent with it
+        fields, filename, content = self.form(headers.get('Content-Type', ''), body)
+        if 'sha256_digest' in fields and fields['sha256_digest'] != hashlib.sha256(content).hexdigest():
+            return 400, {'content': ['The file does not match its sha256_digest']}, {}
+
+        with self.lock:
+            self.uploads.append((headers.get('Content-Type', ''), len(body)))
+            self.files[filename] = content
+        return 201, {}, {}
+
+    def index(self, headers, project: str) -> Tuple[int, object, Dict[str, str]]:
+        """
+        The page of a project in the simple (PEP 503) package index that pip uses
+        """
+        if not self.authorized(headers):
+            return 401, {'detail': 'Invalid credentials'}, {}
+
+        with self.lock:
+            files = {
+                name: hashlib.sha256(content).hexdigest() for name, content in self.files.items()
+                if re.sub(r'[-_.]+', '-', name.split('-')[0]).lower() == project
+            }
+        if not files:
+            return 404, None, {}
+
+        links = ''.join(f'<a href="../../files/{name}#sha256={digest}">{name}</a><br>\n'
+                        for name, digest in sorted(files.items()))
+        return 200, f'<html><body>{links}</body></html>'.encode(), {'Content-Type': 'text/html'}
+
+    def download(self, headers, name: str) -> Tuple[int, object, Dict[str, str]]:
+        if not self.authorized(headers):
+            return 401, {'detail': 'Invalid credentials'}, {}
+        if name not in self.files:
+            return 404, None, {}
+        return 200, self.files[name], {'Content-Type': 'application/octet-stream'}
+
+    @staticmethod
+    def form(content_type: str, body: bytes) -> Tuple[Dict[str, str], str, bytes]:
+        """
+        Splits a multipart/form-data body into its fields and the name and content of its file
+        """
+        match = re.search(r'boundary=(\S+)', content_type)
+        fields, filename, content = {}, '', b''
+        if not match:
+            return fields, filename, content
+
+        for part in body.split(b'--' + match.group(1).encode())[1:-1]:
+            head, _, value = part[2:-2].partition(b'\r\n\r\n')
+            name = re.search(rb'name="([^"]*)"', head)
+            if b'filename=' in head:
+                filename = re.search(rb'filename="([^"]*)"', head).group(1).decode()
+                content = value
+            elif name:
+                fields[name.group(1).decode()] = value.decode()
+        return fields, filename, content
+
+    def listing(self, name: str, items: List[dict], headers, query) -> Tuple[int, object, Dict[str, str]]:
+        page = int(query.get('page', ['1'])[0])
+        filters = {key: values[0] for key, values in query.items() if key != 'page'} if self.filters else {}
+        items = [item for item in items if all(item.get(key) == value for key, value in filters.items())]
+        etag = f'"{name}-{self.versions[name]}-{page}-{sorted(filters.items())}"'
+        if headers.get('If-None-Match') == etag:
+            return 304, None, {'ETag': etag}
+
+        if not self.page_size:
+            return 200, items, {'ETag': etag}
+
+        start = (page - 1) * self.page_size
+        if page < 1 or (start >= len(items) and page > 1):
+            return 404, {'detail': 'Invalid page.'}, {}
+
+        url = f'{self.url}api/v1/{name}/?{urlencode(dict(filters, page=""))}'
+        return 200, {
+            'count': len(items),
+            'next': f'{url}{page + 1}' if start + self.page_size < len(items) else None,
+            'previous': f'{url}{page - 1}' if page > 1 else None,
+            'results': items[start:start + self.page_size],
+        }, {'ETag': etag}
+
+    def api(self, method: str, parts: List[str], headers, body: bytes, query) -> Tuple[int, object, Dict[str, str]]:
+        if method == 'GET' and parts == ['packages']:
+            return self.listing('packages', self.packages, headers, query)
+
+        if method == 'GET' and parts == ['subusers']:
+            return self.listing('subusers', self.users, headers, query)
+
+        if method == 'GET' and parts == ['tokens']:
+            return self.listing('tokens', self.tokens, headers, query)
+
+        if method == 'POST' and parts == ['tokens']:
+            form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            if any(t['package'] == form.get('package') and t['user'] == form.get('user') for t in self.tokens):
+                return 400, {'non_field_errors': ['This token already exists']}, {}
+            token = {
+                'uuid': f't{self.next_token:08d}',
+                'package': form.get('package'),
+                'user': form.get('user'),
+                'write_access': form.get('write_access') == 'True',
+            }
+            self.tokens.append(token)
+            self.next_token += 1
+            self.versions['tokens'] += 1
+            return 201, token, {}
+
+        if method == 'DELETE' and len(parts) == 2 and parts[0] == 'tokens':
+            for token in self.tokens:
+                if token['uuid'] == parts[1]:
+                    self.tokens.remove(token)
+                    self.versions['tokens'] += 1
+                    return 204, None, {}
+            return 404, {'detail': 'Not found.'}, {}
+
+        if method == 'POST' and parts == ['files', 'lookup']:
+            return 200, [], {}
+
+        return 404, {'detail': 'Not found.'}, {}